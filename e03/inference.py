@@ -0,0 +1,255 @@
+"""
+Score gesture recordings with model.joblib.
+
+GestureModel loads the model once and predicts batches of preprocessed feature rows or raw recordings.
+MicroBatcher collects single requests from many threads for at most max_delay seconds, or until max_batch
+requests are waiting, and scores them with one call to the model.
+
+    python inference.py --port 5200
+    python inference.py --port 5200 --axes 1   # also accept raw recordings, model.joblib scores 20 points of x
+    curl -X POST localhost:5200/predict -H "Content-Type: application/json" -d '{"samples": [[[0.1, 0.2, ...]]]}'
+    curl localhost:5200/metrics
+"""
+import argparse
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import perf_counter
+from typing import List, Optional, Sequence, Union
+
+import joblib
+import numpy as np
+from flask import Flask, request, jsonify
+
+from preprocessing import resample
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model.joblib")
+
+# a preprocessed row of features or a raw recording, the series of every axis
+Sample = Union[Sequence[float], Sequence[Sequence[float]]]
+
+
+class LatencyStats:
+    """
+    Throughput and latency percentiles of the last window requests
+    """
+    requests: int
+    samples: int
+    batches: int
+
+    def __init__(self, window: int = 10000):
+        self.requests = 0
+        self.samples = 0
+        self.batches = 0
+        self._latencies = deque(maxlen=window)
+        self._start = perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, latencies: Sequence[float], samples: int):
+        """
+        :param latencies: seconds until each request of a batch was answered
+        :param samples: number of scored samples of the batch
+        """
+        with self._lock:
+            self.requests += len(latencies)
+            self.samples += samples
+            self.batches += 1
+            self._latencies.extend(latencies)
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.samples = self.batches = 0
+            self._latencies.clear()
+            self._start = perf_counter()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = perf_counter() - self._start
+            latencies = np.array(self._latencies) * 1000
+            p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) > 0 else (0.0, 0.0)
+            return {"requests": self.requests,
+                    "samples": self.samples,
+                    "batches": self.batches,
+                    "mean_batch_size": self.samples / self.batches if self.batches > 0 else 0.0,
+                    "throughput": self.samples / elapsed if elapsed > 0 else 0.0,
+                    "p50_ms": float(p50),
+                    "p99_ms": float(p99)}
+
+
+class GestureModel:
+    """
+    Classifier of model.joblib, loaded once with its arrays memory mapped
+    """
+    path: str
+    n_features: int
+    classes: np.ndarray
+    axes: Optional[int]
+    points: Optional[int]
+
+    def __init__(self, path: str = MODEL_PATH, mmap_mode: Optional[str] = "r",
+                 axes: Optional[int] = None, points: Optional[int] = None):
+        """
+        :param axes: axes of the raw recordings the model was trained on, raw recordings are rejected if None
+        :param points: values per axis, n_features / axes by default
+        """
+        self.path = path
+        self.model = joblib.load(path, mmap_mode=mmap_mode)
+        self.n_features = self.model.n_features_in_
+        self.classes = self.model.classes_
+        self.axes = axes
+        self.points = points if points is not None or axes is None else self.n_features // axes
+        if axes is not None and axes * self.points != self.n_features:
+            raise ValueError(f"{axes} axes of {self.points} points do not match the {self.n_features} features "
+                             + "of the model")
+
+    def features(self, samples: Sequence[Sample]) -> np.ndarray:
+        """
+        Rows of n_features values are used as they are, raw recordings of the configured axes are resampled
+        to points values per axis like preprocessing.py does
+        :return: float32 matrix with a row per sample
+        """
+        rows = []
+        for sample in samples:
+            if len(sample) > 0 and np.ndim(sample[0]) > 0:
+                if self.axes is None:
+                    raise ValueError("raw recordings are not accepted, the axes of the model are not configured")
+                if len(sample) != self.axes:
+                    raise ValueError(f"expected a recording of {self.axes} axes but got {len(sample)}")
+                sample = resample([list(axis) for axis in sample], self.points).ravel()
+            elif len(sample) != self.n_features:
+                raise ValueError(f"expected {self.n_features} features but got {len(sample)}")
+            rows.append(np.asarray(sample, dtype=np.float32))
+        return np.vstack(rows) if len(rows) > 0 else np.empty((0, self.n_features), dtype=np.float32)
+
+    def predict(self, samples: Union[np.ndarray, Sequence[Sample]]) -> np.ndarray:
+        """
+        :return: gesture of every sample
+        """
+        features = samples if isinstance(samples, np.ndarray) and samples.ndim == 2 else self.features(samples)
+        if len(features) == 0:
+            return np.empty(0, dtype=self.classes.dtype)
+        return self.model.predict(features)
+
+
+class MicroBatcher:
+    """
+    Scores single samples in batches. The first waiting request opens a window of max_delay seconds,
+    everything that arrives within the window, up to max_batch requests, is scored together.
+    """
+    model: GestureModel
+    max_batch: int
+    max_delay: float
+    stats: LatencyStats
+
+    def __init__(self, model: GestureModel, max_batch: int = 64, max_delay: float = 0.002):
+        """
+        :param max_batch: maximum number of requests per call to the model
+        :param max_delay: seconds a request waits for others to join its batch
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = LatencyStats()
+        self._requests = queue.Queue()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, sample: Sample) -> Future:
+        """
+        :return: future of the gesture of the sample
+        """
+        if self._closed.is_set():
+            raise RuntimeError("MicroBatcher is closed")
+        future = Future()
+        self._requests.put((sample, future, perf_counter()))
+        return future
+
+    def predict(self, sample: Sample, timeout: Optional[float] = None) -> str:
+        return self.submit(sample).result(timeout)
+
+    def predict_many(self, samples: Sequence[Sample]) -> List[str]:
+        """
+        Score a batch right away, it already is a batch
+        """
+        start = perf_counter()
+        gestures = self.model.predict(samples)
+        self.stats.record([perf_counter() - start], len(gestures))
+        return gestures.tolist()
+
+    def close(self):
+        self._closed.set()
+        self._requests.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            first = self._requests.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first[2] + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - perf_counter()
+                try:
+                    item = self._requests.get(timeout=remaining) if remaining > 0 else self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._requests.put(None)
+                    break
+                batch.append(item)
+            self._score(batch)
+
+    def _score(self, batch: list):
+        try:
+            gestures = self.model.predict([sample for sample, _, _ in batch])
+        except Exception:
+            # score one by one so a malformed sample only fails its own request
+            for sample, future, _ in batch:
+                try:
+                    future.set_result(str(self.model.predict([sample])[0]))
+                except Exception as e:
+                    future.set_exception(e)
+            return
+        done = perf_counter()
+        for (_, future, received), gesture in zip(batch, gestures):
+            future.set_result(str(gesture))
+        self.stats.record([done - received for _, _, received in batch], len(batch))
+
+
+def create_app(batcher: MicroBatcher) -> Flask:
+    app = Flask(__name__)
+
+    @app.route("/predict", methods=["POST"])
+    def predict():
+        body = request.get_json(force=True)
+        try:
+            if "sample" in body:
+                return jsonify({"gesture": batcher.predict(body["sample"])})
+            return jsonify({"gestures": batcher.predict_many(body["samples"])})
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    @app.route("/metrics")
+    def metrics():
+        return jsonify(batcher.stats.snapshot())
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve gesture predictions of model.joblib")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5200)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-delay", type=float, default=0.002, help="seconds a request waits for a batch")
+    parser.add_argument("--axes", type=int, help="axes of raw recordings, raw recordings are rejected by default")
+    parser.add_argument("--points", type=int, help="values per axis the raw recordings are resampled to")
+    args = parser.parse_args()
+    model = GestureModel(args.model, axes=args.axes, points=args.points)
+    create_app(MicroBatcher(model, args.max_batch, args.max_delay)) \
+        .run(host=args.host, port=args.port, threaded=True)
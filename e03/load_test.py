@@ -0,0 +1,85 @@
+"""
+Load test of the micro batched inference. clients threads send single samples for duration seconds,
+once without batching and once for every latency window.
+
+    python load_test.py --clients 32 --duration 5 --max-delay 0.001 0.005
+    python load_test.py --raw --axes 1   # send raw recordings of raw/<sensor> instead of preprocessed rows
+"""
+import argparse
+import itertools
+import os
+import threading
+from time import perf_counter
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from inference import GestureModel, MicroBatcher, Sample
+from preprocessing import AXES, METADATA, read_batches, sensor_files
+
+PREPROCESSED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gesture_recognition_preprocessed_data.csv")
+
+
+def preprocessed_samples(model: GestureModel, path: str = PREPROCESSED) -> List[Sample]:
+    df = pd.read_csv(path)
+    return df.iloc[:, len(METADATA):len(METADATA) + model.n_features].to_numpy(dtype=np.float32).tolist()
+
+
+def raw_samples(model: GestureModel, sensor: str) -> List[Sample]:
+    """
+    :return: recordings of the sensor with the axes of the model
+    """
+    if model.axes is None:
+        raise ValueError("the axes of the model are not configured")
+    samples = []
+    for batch in read_batches(sensor_files(sensor, axes=AXES[:model.axes]), 4096):
+        samples += [[[float(value) for value in line[len(METADATA):] if value != ""] for line in row] for row in batch]
+    return samples
+
+
+def run(batcher: MicroBatcher, samples: List[Sample], clients: int, duration: float) -> dict:
+    batcher.stats.reset()
+    stop = perf_counter() + duration
+    errors = []
+
+    def client(offset: int):
+        for sample in itertools.islice(itertools.cycle(samples), offset, None):
+            if perf_counter() > stop:
+                return
+            try:
+                batcher.predict(sample)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=client, args=(i * len(samples) // clients,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return batcher.stats.snapshot()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure throughput and latency of the micro batched inference")
+    parser.add_argument("--clients", type=int, default=32, help="threads sending single samples")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per run")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-delay", type=float, nargs="+", default=[0.001, 0.005], help="latency windows")
+    parser.add_argument("--raw", action="store_true", help="send raw recordings")
+    parser.add_argument("--sensor", default="wear")
+    parser.add_argument("--axes", type=int, default=1, help="axes of the raw recordings, 1 for model.joblib")
+    args = parser.parse_args()
+
+    model = GestureModel(axes=args.axes if args.raw else None)
+    samples = raw_samples(model, args.sensor) if args.raw else preprocessed_samples(model)
+    print(f"{'max batch':>9} {'window [ms]':>11} {'samples/s':>10} {'batch':>6} {'p50 [ms]':>9} {'p99 [ms]':>9}")
+    for max_batch, max_delay in [(1, 0.0)] + [(args.max_batch, delay) for delay in args.max_delay]:
+        batcher = MicroBatcher(model, max_batch, max_delay)
+        stats = run(batcher, samples, args.clients, args.duration)
+        batcher.close()
+        print(f"{max_batch:>9} {max_delay * 1000:>11.1f} {stats['throughput']:>10.0f} {stats['mean_batch_size']:>6.1f} "
+              + f"{stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
@@ -0,0 +1,219 @@
+"""
+Preprocess the raw gesture recordings into a fixed number of points per axis.
+
+Every raw file holds one axis of a sensor, a row is a recording: gesture,person,sample,value,value,...
+Rows have a different number of values and may be padded with empty fields. The files of the axes are read in
+lockstep, each recording is resampled to points values per axis by linear interpolation and written to
+    <output>/features.npy  float32 matrix, one row per recording: X1..Xn of the first axis, X1.1..Xn.1 of the second, ...
+    <output>/gesture.npy, person.npy, sample.npy
+Only batch_size rows per worker are held in memory at a time, batches are processed on all cores.
+
+The values are not identical to gesture_recognition_preprocessed_data.csv, which was resampled differently:
+for the wear sensor the largest absolute difference is about 20 and the mean absolute difference 0.26. Models trained
+on the reference csv should be scored with features of that csv, keep it as it is and write the output elsewhere.
+
+    python preprocessing.py wear --csv preprocessed/wear.csv
+    python preprocessing.py --files raw/myo/raw_data_myo_x.csv raw/myo/raw_data_myo_y.csv --output preprocessed/myo_xy
+"""
+import argparse
+import csv
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Sequence, Tuple, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+RAW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "raw")
+AXES = ["x", "y", "z"]
+METADATA = ["gesture", "person", "sample"]
+GESTURE_DTYPE = "U32"
+
+Batch = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def sensor_files(sensor: str, raw_dir: str = RAW_DIR, axes: Sequence[str] = AXES) -> List[str]:
+    """
+    :return: raw files of the axes of a sensor, raw/<sensor>/raw_data_<sensor>_<axis>.csv
+    """
+    return [os.path.join(raw_dir, sensor, f"raw_data_{sensor}_{axis}.csv") for axis in axes]
+
+
+def columns(axes: int, points: int) -> List[str]:
+    """
+    :return: names of the feature columns, numbered like the columns of the preprocessed csv
+    """
+    return [f"X{i + 1}" + (f".{axis}" if axis > 0 else "") for axis in range(axes) for i in range(points)]
+
+
+def count_rows(path: str) -> int:
+    with open(path, "rb") as infile:
+        return sum(1 for line in infile if line.strip() != b"")
+
+
+def read_batches(paths: Sequence[str], batch_size: int) -> Iterator[List[Tuple[List[str], ...]]]:
+    """
+    Read the files of the axes in lockstep
+    :return: batches of rows, a row holds the parsed line of every axis
+    """
+    files = [open(path, "r", newline="") for path in paths]
+    try:
+        rows = zip(*(csv.reader(line for line in file if line.strip() != "") for file in files))
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if len(batch) == 0:
+                return
+            yield batch
+    finally:
+        for file in files:
+            file.close()
+
+
+def resample(series: List[list], points: int) -> np.ndarray:
+    """
+    Linearly interpolate every series to points evenly spaced values, empty series become nan
+    :param series: values of the series, numbers or strings as read from the csv, empty strings are dropped
+    :return: float32 matrix with a row per series
+    """
+    values = [[value for value in values if value != ""] for values in series]
+    lengths = np.array([len(v) for v in values])
+    padded = np.zeros((len(values), max(1, lengths.max(initial=0))), dtype=np.float64)
+    for i, v in enumerate(values):
+        padded[i, :len(v)] = v
+    positions = np.linspace(0, 1, points)[None, :] * np.maximum(lengths - 1, 0)[:, None]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(lengths - 1, 0)[:, None])
+    fraction = positions - lower
+    rows = np.arange(len(values))[:, None]
+    resampled = padded[rows, lower] * (1 - fraction) + padded[rows, upper] * fraction
+    resampled[lengths == 0] = np.nan
+    return resampled.astype(np.float32)
+
+
+def preprocess_batch(batch: List[Tuple[List[str], ...]], points: int) -> Batch:
+    """
+    Rows of the axes have to agree on gesture and person. The sample ids are taken from the first axis,
+    raw_data_wear_z.csv numbers some samples of person 2 differently than the other axes.
+    :return: gesture, person, sample and features of the rows
+    """
+    for row in batch:
+        ids = [tuple(line[:2]) for line in row]
+        if any(axis_ids != ids[0] for axis_ids in ids):
+            raise ValueError(f"axis files are out of step, rows {ids} do not belong to the same recording")
+    first = [row[0] for row in batch]
+    gesture = np.array([line[0] for line in first], dtype=GESTURE_DTYPE)
+    person = np.array([line[1] for line in first], dtype=np.int32)
+    sample = np.array([line[2] for line in first], dtype=np.int32)
+    features = np.hstack([resample([row[axis][len(METADATA):] for row in batch], points)
+                          for axis in range(len(batch[0]))])
+    return gesture, person, sample, features
+
+
+class Output:
+    """
+    Memory mapped npy files of the preprocessed recordings
+    """
+    directory: str
+
+    def __init__(self, directory: str, rows: int, axes: int, points: int):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.gesture = self._open("gesture", (rows,), GESTURE_DTYPE)
+        self.person = self._open("person", (rows,), np.int32)
+        self.sample = self._open("sample", (rows,), np.int32)
+        self.features = self._open("features", (rows, axes * points), np.float32)
+        self.rows = 0
+
+    def _open(self, name: str, shape: tuple, dtype) -> np.memmap:
+        return np.lib.format.open_memmap(os.path.join(self.directory, f"{name}.npy"), mode="w+",
+                                         dtype=dtype, shape=shape)
+
+    def write(self, batch: Batch):
+        end = self.rows + len(batch[0])
+        for array, values in zip([self.gesture, self.person, self.sample, self.features], batch):
+            array[self.rows:end] = values
+        self.rows = end
+
+    def close(self):
+        for array in [self.gesture, self.person, self.sample, self.features]:
+            array.flush()
+
+
+def preprocess(paths: Sequence[str], output: str, points: int = 20, batch_size: int = 4096,
+               workers: Optional[int] = None) -> int:
+    """
+    :param paths: raw files of the axes, in the order of the feature columns
+    :param output: directory of the npy files
+    :param points: values per axis
+    :param workers: number of processes, all cores by default
+    :return: number of preprocessed recordings
+    """
+    workers = workers if workers is not None else os.cpu_count()
+    rows = count_rows(paths[0])
+    out = Output(output, rows, len(paths), points)
+    batches = read_batches(paths, batch_size)
+    if workers <= 1:
+        for batch in batches:
+            out.write(preprocess_batch(batch, points))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(preprocess_batch, batch, points))
+                while len(pending) > 2 * workers:
+                    out.write(pending.popleft().result())
+            while len(pending) > 0:
+                out.write(pending.popleft().result())
+    out.close()
+    if out.rows != rows:
+        raise ValueError(f"axis files are out of step, {paths[0]} has {rows} rows but only {out.rows} were read")
+    return out.rows
+
+
+def load(output: str, axes: int = len(AXES), mmap_mode: Optional[str] = "r") -> pd.DataFrame:
+    """
+    :return: preprocessed recordings in the layout of gesture_recognition_preprocessed_data.csv
+    """
+    features = np.load(os.path.join(output, "features.npy"), mmap_mode=mmap_mode)
+    gesture, person, sample = (np.load(os.path.join(output, f"{name}.npy")) for name in METADATA)
+    df = pd.DataFrame(features, columns=columns(axes, features.shape[1] // axes))
+    df.insert(0, "gesture", gesture)
+    df.insert(1, "person", person)
+    df.insert(2, "sample", sample)
+    return df
+
+
+def write_csv(output: str, path: str, axes: int, chunk_size: int = 65536):
+    """
+    Write the preprocessed recordings as csv, chunk by chunk
+    """
+    features = np.load(os.path.join(output, "features.npy"), mmap_mode="r")
+    metadata = [np.load(os.path.join(output, f"{name}.npy"), mmap_mode="r") for name in METADATA]
+    header = METADATA + columns(axes, features.shape[1] // axes)
+    for start in range(0, len(features), chunk_size):
+        end = start + chunk_size
+        df = pd.DataFrame(features[start:end], columns=header[len(METADATA):])
+        for i, (name, values) in enumerate(zip(METADATA, metadata)):
+            df.insert(i, name, values[start:end])
+        df.to_csv(path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resample the raw gesture recordings to a fixed length")
+    parser.add_argument("sensor", nargs="?", default="wear", help="sensor in raw/, e.g. wear or myo")
+    parser.add_argument("--files", nargs="+", help="raw files of the axes instead of the files of a sensor")
+    parser.add_argument("--output", help="directory of the npy files, preprocessed/<sensor> by default")
+    parser.add_argument("--points", type=int, default=20, help="values per axis")
+    parser.add_argument("--batch-size", type=int, default=4096, help="rows per batch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--csv", help="also write the recordings to this csv, e.g. preprocessed/wear.csv")
+    args = parser.parse_args()
+
+    files = args.files if args.files is not None else sensor_files(args.sensor)
+    output = args.output if args.output is not None else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      "preprocessed", args.sensor)
+    print("preprocessed", preprocess(files, output, args.points, args.batch_size, args.workers), "recordings to", output)
+    if args.csv is not None:
+        write_csv(output, args.csv, len(files))
@@ -0,0 +1,57 @@
+import os
+import pickle
+import threading
+from typing import Dict, List, Optional
+
+from tekore._model import FullArtist
+
+from project.metrics import METRICS
+
+
+class ArtistCache:
+    """
+    Artists retrieved during a crawl, optionally persisted to a pickle file so later crawls can reuse them
+    """
+    path: Optional[str]
+    _artists: Dict[str, FullArtist]
+    _lock: threading.Lock
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._artists = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as infile:
+                self._artists = pickle.load(infile)
+
+    def missing(self, artist_ids: List[str]) -> List[str]:
+        """
+        :return: the unique ids that are not cached, in the order of their first occurrence
+        """
+        with self._lock:
+            missing = [artist_id for artist_id in dict.fromkeys(artist_ids) if artist_id not in self._artists]
+        METRICS.increment("artist_cache_misses", len(missing))
+        METRICS.increment("artist_cache_hits", len(set(artist_ids)) - len(missing))
+        return missing
+
+    def get_many(self, artist_ids: List[str]) -> List[FullArtist]:
+        with self._lock:
+            return [self._artists[artist_id] for artist_id in dict.fromkeys(artist_ids)
+                    if artist_id in self._artists]
+
+    def put_many(self, artists: List[FullArtist]):
+        with self._lock:
+            for artist in artists:
+                if artist is not None:
+                    self._artists[artist.id] = artist
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            artists = dict(self._artists)
+        with open(self.path, "wb") as outfile:
+            pickle.dump(artists, outfile)
+
+    def __len__(self):
+        return len(self._artists)
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import logging
+from typing import List, Optional, Tuple, Set
+
+import tekore as tk
+from dotenv import load_dotenv
+from pymongo.collection import Collection
+from tekore import Spotify, Credentials
+from tekore.model import FullPlaylistTrack
+
+from authentication.spotify_server import SpotifyServer
+from project.artist_cache import ArtistCache
+from project.crawler import ANALYSIS_ERRORS, ArtistRounds, analysis_failed, connect_database, enrich_tracks, \
+    load_spotify_token, save_tracks, set_tags, store_spotify_token
+from project.metrics import METRICS, MeteredSender, configure_logging
+from project.playlist_tracks import PlaylistTracks
+from project.random_tracks import RandomTracks, stored_track_ids
+from project.rate_limit import HostLimiter, limiter_for
+from project.util import Partition
+from lastfm import AsyncLastFmScraper, cached_tags, merge_fetched_tags
+from lastfm.cache import TagCache
+import track as model
+
+logger = logging.getLogger(__name__)
+
+
+class SharedToken:
+    """
+    Spotify token shared by all requests of an AsyncCrawler. Only the first request that finds the token
+    expiring refreshes it, the others wait for the lock and then use the new token.
+    """
+    spotify: Spotify
+    credentials: Credentials
+    refreshes: int
+    _lock: asyncio.Lock
+
+    def __init__(self, spotify: Spotify, credentials: Credentials):
+        self.spotify = spotify
+        self.credentials = credentials
+        self.refreshes = 0
+        self._lock = asyncio.Lock()
+
+    async def fresh(self):
+        if not self.spotify.token.is_expiring:
+            return
+        async with self._lock:
+            if self.spotify.token.is_expiring:
+                self.spotify.token = await self.credentials.refresh(self.spotify.token)
+                self.refreshes += 1
+                METRICS.increment("token_refreshes")
+                logger.info("refreshed spotify credentials")
+
+
+class AsyncCrawler:
+    """
+    Crawler on top of tekore's asynchronous client. Up to concurrency requests are in flight at once,
+    all of them sharing the rate limit of the host and a single token.
+    """
+    _host: str
+    _port: int
+    _spotify: Spotify
+    _cred: Credentials
+    _token: SharedToken
+    _scraper: AsyncLastFmScraper
+    _tag_cache: TagCache
+    _track_collection: Collection
+    _spotify_limiter: HostLimiter
+    _artist_cache: ArtistCache
+    _concurrency: int
+    _pages_in_flight: int
+    _in_flight: Optional[asyncio.Semaphore]
+
+    def __init__(self, host: str, port: int,
+                 concurrency: int = 64,
+                 pages_in_flight: int = 4,
+                 artist_cache_path: Optional[str] = None) -> None:
+        """
+        :param concurrency: maximum number of spotify requests in flight
+        :param pages_in_flight: number of playlist pages fetched and processed at the same time
+        """
+        self._host = host
+        self._port = port
+        self._concurrency = concurrency
+        self._pages_in_flight = pages_in_flight
+        self._spotify_limiter = limiter_for("api.spotify.com")
+        self._artist_cache = ArtistCache(artist_cache_path)
+        self._in_flight = None
+
+        load_dotenv()
+
+        self._conf = tk.config_from_environment()
+        self._cred = tk.Credentials(*self._conf, asynchronous=True)
+        self._spotify = tk.Spotify(sender=MeteredSender(tk.AsyncSender()))
+        self._token = SharedToken(self._spotify, self._cred)
+        self._scraper = AsyncLastFmScraper(max_connections=concurrency)
+        self._tag_cache = TagCache()
+
+        db = connect_database()
+        self._track_collection = db['tracks']
+        self._track_collection.create_index("id")
+
+    async def collect_tracks_from_playlist(self, playlist_id: str, offset: int = 0):
+        await self._set_spotify_credentials()
+        limit = PlaylistTracks.limit
+        completed = False
+        while not completed:
+            offsets = [offset + i * limit for i in range(self._pages_in_flight)]
+            logger.info("loading playlist %s offsets %s", playlist_id, offsets,
+                        extra={"playlist_id": playlist_id, "offset": offset})
+            pages = await asyncio.gather(*(self._retrieve_playlist_page(playlist_id, page_offset)
+                                           for page_offset in offsets))
+            # a short page is the last one, even if none of its items is a track
+            completed = any(items < limit for items, _ in pages)
+            await asyncio.gather(*(self._crawl_page(tracks) for _, tracks in pages if len(tracks) > 0))
+            offset += len(offsets) * limit
+        self._artist_cache.save()
+
+    async def collect_random_tracks(self, count: int = 50):
+        """
+        Sample count random tracks that are not stored yet, see RandomTracks.sample
+        """
+        await self._set_spotify_credentials()
+        random_tracks = RandomTracks(self._spotify, self._cred)
+        seen = await asyncio.to_thread(stored_track_ids, self._track_collection)
+        sampled = 0
+        requests = 0
+        while sampled < count and requests < RandomTracks.max_requests(count):
+            searches = [self._call(self._spotify.search, query, market=market, limit=RandomTracks.limit, offset=offset)
+                        for query, market, offset in (random_tracks.random_query()
+                                                      for _ in range(self._pages_in_flight))]
+            results = await asyncio.gather(*searches, return_exceptions=True)
+            requests += len(searches)
+            tracks = [track for result in results if not isinstance(result, Exception)
+                      for track in result[0].items if track is not None]
+            new_tracks = [track for track in tracks if seen.add(track.id)][:count - sampled]
+            random_tracks.stats.add(requests=len(searches), fetched=len(tracks), new=len(new_tracks))
+            if len(new_tracks) > 0:
+                await self._crawl_page(new_tracks)
+            sampled += len(new_tracks)
+        logger.info("%s", random_tracks.stats)
+        self._artist_cache.save()
+
+    async def close(self):
+        await self._scraper.close()
+        await self._spotify.close()
+        await self._cred.close()
+        self._tag_cache.close()
+
+    async def _crawl_page(self, tracks: list):
+        logger.info("analyzing %d tracks", len(tracks), extra={"tracks": len(tracks)})
+        METRICS.increment("tracks_analyzed", len(tracks))
+        artists = await self._retrieve_artists(tracks)
+        analyzed_tracks = model.AnalyzedTracks(tracks, artists)
+        await asyncio.gather(self._retrieve_tags(analyzed_tracks.tracks),
+                             self._enrich_tracks(analyzed_tracks.tracks))
+        await self._save_tracks(analyzed_tracks)
+
+    @METRICS.timed()
+    async def _save_tracks(self, analyzed_tracks):
+        await asyncio.to_thread(save_tracks, self._track_collection, analyzed_tracks)
+
+    async def _call(self, func, *args, not_found_retries: int = 0, **kwargs):
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self._concurrency)
+        async with self._in_flight:
+            await self._token.fresh()
+            return await self._spotify_limiter.call_async(func, *args, not_found_retries=not_found_retries, **kwargs)
+
+    async def _set_spotify_credentials(self):
+        if self._spotify.token is not None:
+            return
+        try:
+            self._spotify.token = await self._cred.refresh(load_spotify_token())
+        except Exception as e:
+            logger.warning("could not refresh the stored spotify token: %s", e)
+            app = SpotifyServer(self._host, self._port, tk.Spotify(), tk.Credentials(*self._conf))
+            self._spotify.token = await asyncio.to_thread(app.spawn_single_use_server)
+        store_spotify_token(self._spotify.token)
+
+    async def _retrieve_playlist_page(self, playlist_id: str, offset: int) -> Tuple[int, list]:
+        """
+        :return: number of items of the page and its tracks, episodes and removed tracks are left out
+        """
+        page = await self._call(self._spotify.playlist_items, playlist_id=playlist_id,
+                                offset=offset, limit=PlaylistTracks.limit)
+        return len(page.items), [item.track for item in page.items if isinstance(item.track, FullPlaylistTrack)]
+
+    @METRICS.timed()
+    async def _retrieve_artists(self, tracks):
+        rounds = ArtistRounds(self._artist_cache, tracks, self._spotify_limiter.policy.max_retries)
+        while len(rounds.pending) > 0:
+            rounds.add(await asyncio.gather(*(self._call(self._spotify.artists, ids) for ids in rounds.pending),
+                                            return_exceptions=True))
+            if len(rounds.pending) > 0:
+                await self._spotify_limiter.backoff_async(rounds.failed_rounds - 1)
+        return rounds.artists()
+
+    @METRICS.timed()
+    async def _retrieve_tags(self, tracks):
+        rounds = model.TagRounds(tracks)
+        try:
+            while not rounds.finished():
+                rounds.add(await self._get_tags_many(rounds.pairs()))
+        except Exception as e:
+            logger.warning("error retrieving tags: %s", e)
+            return
+        set_tags(tracks, [list(track_tags) for track_tags in rounds.tags])
+
+    async def _get_tags_many(self, pairs: List[Tuple[str, str]]) -> List[Set[str]]:
+        """
+        Same as LastFmProxy.get_tags_many with the asynchronous scraper
+        """
+        tags, missing = await asyncio.to_thread(cached_tags, self._tag_cache, pairs)
+        if len(missing) == 0:
+            return tags
+        fetched_tags = await self._scraper.get_tags_many(missing)
+        return await asyncio.to_thread(merge_fetched_tags, self._tag_cache, pairs, tags, missing, fetched_tags)
+
+    @METRICS.timed()
+    async def _enrich_tracks(self, tracks):
+        track_ids = [track.id for track in tracks]
+        features = await asyncio.gather(*(self._call(self._spotify.tracks_audio_features, ids)
+                                          for ids in Partition(track_ids)))
+        analyses = await asyncio.gather(*(self._retrieve_audio_analysis(track_id) for track_id in track_ids))
+        enrich_tracks(tracks, features, analyses)
+
+    async def _retrieve_audio_analysis(self, track_id: str):
+        try:
+            return await self._call(self._spotify.track_audio_analysis, track_id=track_id, not_found_retries=5)
+        except ANALYSIS_ERRORS as e:
+            analysis_failed(track_id, e)
+        return None
+
+
+async def main(playlist_ids: List[str], concurrency: int):
+    crawler = AsyncCrawler("127.0.0.1", 5000, concurrency=concurrency, artist_cache_path=".spotify_artists.pickle")
+    try:
+        for playlist_id in playlist_ids:
+            await crawler.collect_tracks_from_playlist(playlist_id)
+    finally:
+        await crawler.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl spotify playlists with the asynchronous client")
+    parser.add_argument("playlist_ids", nargs="*", default=["2rcMRS9fDOnuu5YUTXAcQZ"])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--metrics", help="write the metrics of the crawl to this file, .json or Prometheus text")
+    parser.add_argument("--log-json", action="store_true", help="log json lines")
+    args = parser.parse_args()
+    configure_logging(structured=args.log_json)
+    try:
+        asyncio.run(main(args.playlist_ids, args.concurrency))
+    finally:
+        if args.metrics is not None:
+            METRICS.dump(args.metrics)
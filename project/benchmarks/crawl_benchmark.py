@@ -0,0 +1,133 @@
+"""
+Replay a recorded playlist crawl through Crawler and report its throughput.
+
+Record a cassette once (needs spotify credentials and network):
+    python benchmarks/crawl_benchmark.py record 2rcMRS9fDOnuu5YUTXAcQZ --limit 500
+or against the fake spotify server (python fake_spotify.py):
+    python benchmarks/crawl_benchmark.py record fake1 --fake http://127.0.0.1:5100 --limit 500
+Replay it offline, rate limits are lifted so only the crawler itself is measured:
+    python benchmarks/crawl_benchmark.py replay [--pipelined] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import threading
+from time import perf_counter
+from typing import Dict, List
+
+import numpy as np
+import pylast
+import tekore as tk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from authentication.lastfm_credentials import LastFmCredentials  # noqa: E402
+from project.crawler import Crawler, load_spotify_token  # noqa: E402
+from project.fake_spotify import RedirectSender, RedirectSession, fake_token  # noqa: E402
+from project.rate_limit import DEFAULT_LIMITS, limiter_for  # noqa: E402
+from project.replay import Cassette, RecordingSender, RecordingNetwork, ReplayingNetwork, SqliteDatabase, \
+    recording_session, replaying_session, replaying_spotify  # noqa: E402
+from lastfm import LastFmProxy, LastFmScraper  # noqa: E402
+
+STAGES = ["artists", "tags", "enrich", "save"]
+DEFAULT_CASSETTE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "playlist_cassette.json")
+
+
+class StageTimer:
+    """
+    Wraps the stage methods of a crawler and collects the latency of every page
+    """
+    latencies: Dict[str, List[float]]
+
+    def __init__(self, crawler: Crawler):
+        self.latencies = {stage: [] for stage in STAGES}
+        self._lock = threading.Lock()
+        for stage in STAGES:
+            attribute = f"_{stage}_stage"
+            setattr(crawler, attribute, self._timed(stage, getattr(crawler, attribute)))
+
+    def _timed(self, stage: str, func):
+        def wrap(page):
+            start = perf_counter()
+            result = func(page)
+            with self._lock:
+                self.latencies[stage].append(perf_counter() - start)
+            return result
+
+        return wrap
+
+    def report(self) -> str:
+        lines = [f"{'stage':>8} {'pages':>6} {'p50 [ms]':>9} {'p90 [ms]':>9} {'p99 [ms]':>9} {'total [s]':>10}"]
+        for stage, latencies in self.latencies.items():
+            if len(latencies) == 0:
+                continue
+            p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+            lines.append(f"{stage:>8} {len(latencies):>6} {p50:9.1f} {p90:9.1f} {p99:9.1f} {sum(latencies):10.3f}")
+        return "\n".join(lines)
+
+
+def crawl(crawler: Crawler, playlist_id: str, limit: int, pipelined: bool):
+    crawler.collect_pages(crawler.playlist_range_pages(playlist_id, 0, limit), pipelined)
+
+
+def record(args):
+    cassette = Cassette(args.cassette)
+    cassette.recordings = {"meta": {"playlist_id": args.playlist_id, "limit": args.limit}}
+    if args.fake is not None:
+        spotify = tk.Spotify(fake_token(), sender=RecordingSender(cassette, RedirectSender(args.fake)))
+        lastfm = LastFmProxy(None, LastFmScraper(session=recording_session(cassette, RedirectSession(args.fake))),
+                             scraper_only=True)
+    else:
+        credentials = LastFmCredentials()
+        network = pylast.LastFMNetwork(api_key=credentials.api_key, api_secret=credentials.shared_secret)
+        token = tk.Credentials(*tk.config_from_environment()).refresh(load_spotify_token())
+        spotify = tk.Spotify(token, sender=RecordingSender(cassette))
+        lastfm = LastFmProxy(RecordingNetwork(network, cassette), LastFmScraper(session=recording_session(cassette)),
+                             scraper_only=True)
+    crawler = Crawler("127.0.0.1", 5000, spotify=spotify, lastfm=lastfm, database=SqliteDatabase())
+    crawl(crawler, args.playlist_id, args.limit, pipelined=False)
+    cassette.save()
+    print("recorded", cassette.total_calls(), "requests to", args.cassette)
+
+
+def replay(args):
+    for host in DEFAULT_LIMITS:
+        limiter = limiter_for(host)
+        limiter.bucket.capacity = 1e9
+        limiter.bucket.set_rate(1e9)
+    for run in range(args.repeat):
+        cassette = Cassette(args.cassette)
+        meta = cassette.recordings["meta"]
+        database = SqliteDatabase()
+        lastfm = LastFmProxy(ReplayingNetwork(cassette), LastFmScraper(session=replaying_session(cassette)),
+                             scraper_only=True)
+        crawler = Crawler("127.0.0.1", 5000, spotify=replaying_spotify(cassette), lastfm=lastfm, database=database)
+        timer = StageTimer(crawler)
+        start = perf_counter()
+        crawl(crawler, meta["playlist_id"], meta["limit"], args.pipelined)
+        elapsed = perf_counter() - start
+        tracks = database["tracks"].estimated_document_count()
+        print(f"run {run + 1}: {tracks} tracks in {elapsed:.2f}s, {tracks / elapsed:.1f} tracks/s, "
+              + f"{cassette.total_calls() / max(1, tracks):.2f} api calls/track {cassette.calls}")
+        print(timer.report())
+        database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record and replay a playlist crawl")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record")
+    record_parser.add_argument("playlist_id")
+    record_parser.add_argument("--limit", type=int, default=500, help="number of playlist tracks to crawl")
+    record_parser.add_argument("--fake", help="record from the fake spotify server at this url")
+    record_parser.add_argument("--cassette", default=DEFAULT_CASSETTE)
+    replay_parser = commands.add_parser("replay")
+    replay_parser.add_argument("--cassette", default=DEFAULT_CASSETTE)
+    replay_parser.add_argument("--pipelined", action="store_true")
+    replay_parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args)
+    else:
+        replay(args)
@@ -0,0 +1,66 @@
+"""
+Micro-benchmark of the artist and audio feature joins of a crawled page.
+
+Run from the project directory: python benchmarks/join_benchmark.py
+"""
+import os
+import random
+import sys
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from track import AnalyzedTrack, AnalyzedTracks  # noqa: E402
+from util import index_by_id  # noqa: E402
+
+SIZES = [1_000, 2_000, 4_000, 8_000, 16_000, 32_000, 64_000]
+QUADRATIC_LIMIT = 4_000
+
+
+def fake_page(n_tracks: int, artists_per_track: int = 2):
+    artists = [SimpleNamespace(id=f"artist{i}", name=f"Artist {i}", genres=["rock", "pop"])
+               for i in range(n_tracks)]
+    tracks = [SimpleNamespace(id=f"track{i}",
+                              name=f"Track {i}",
+                              duration_ms=180_000,
+                              artists=random.sample(artists, artists_per_track))
+              for i in range(n_tracks)]
+    features = [SimpleNamespace(id=f"track{i}") for i in range(n_tracks)]
+    random.shuffle(features)
+    return tracks, artists, features
+
+
+def quadratic_join(tracks, artists, features):
+    analyzed = [AnalyzedTrack(track, [artist
+                                      for artist in artists
+                                      if artist.id in [a.id for a in track.artists]]
+                              ) for track in tracks]
+    for track in analyzed:
+        [feature for feature in features if feature is not None and feature.id == track.id]
+    return analyzed
+
+
+def indexed_join(tracks, artists, features):
+    analyzed = AnalyzedTracks(tracks, artists).tracks
+    features_by_id = index_by_id(features)
+    for track in analyzed:
+        features_by_id.get(track.id)
+    return analyzed
+
+
+def measure(join, *page) -> float:
+    start = perf_counter()
+    join(*page)
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    print(f"{'tracks':>8} {'indexed [s]':>12} {'us/track':>9} {'quadratic [s]':>14}")
+    for size in SIZES:
+        page = fake_page(size)
+        indexed = measure(indexed_join, *page)
+        quadratic = f"{measure(quadratic_join, *page):14.3f}" if size <= QUADRATIC_LIMIT else f"{'-':>14}"
+        print(f"{size:>8} {indexed:12.3f} {indexed / size * 1e6:9.2f} {quadratic}")
@@ -0,0 +1,110 @@
+"""
+Memory and serialisation cost of a page of AnalyzedTracks compared to the former plain objects,
+which kept their fields in a __dict__ and the encoded pitch document on the track.
+
+Run from the project directory: python benchmarks/track_memory_benchmark.py [--tracks 5000] [--segments 800]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from pitches import encode_pitches  # noqa: E402
+from track import AnalyzedTrack  # noqa: E402
+
+FEATURES = ["acousticness", "energy", "danceability", "instrumentalness", "liveness", "loudness", "tempo",
+            "valence"]
+
+
+class PlainTrack:
+    """
+    AnalyzedTrack as it was before it had slots
+    """
+
+    def __init__(self, full_track, artists):
+        self.id = full_track.id
+        self.name = full_track.name
+        self.duration = full_track.duration_ms
+        self.artist_genres = list(dict.fromkeys(genre for artist in artists for genre in artist.genres))
+        self.artist_names = list(dict.fromkeys(artist.name for artist in artists))
+
+    def to_document(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if value is not None}
+
+    def __repr__(self):
+        return f"AnalyzedTrack(id={self.id}, " \
+               + f"name={self.name}, " \
+               + f"tags={self.tags}, " \
+               + f"pitches={self.pitches}, " \
+               + f"tempo={self.tempo} )"
+
+
+def fake_page(n_tracks: int, segments: int):
+    artists = [SimpleNamespace(name=f"Artist {i}", genres=["rock", "pop", "indie"]) for i in range(2)]
+    tracks = [SimpleNamespace(id=f"track{i:06d}", name=f"Track {i}", duration_ms=180_000) for i in range(n_tracks)]
+    starts = [np.cumsum(np.random.rand(segments)) for _ in range(n_tracks)]
+    values = [np.random.rand(segments, 12).astype(np.float32) for _ in range(n_tracks)]
+    return tracks, artists, starts, values
+
+
+def build(cls, page):
+    tracks, artists, starts, values = page
+    analyzed = []
+    for track, track_starts, track_values in zip(tracks, starts, values):
+        analyzed_track = cls(track, artists)
+        analyzed_track.tags = ["rock", "alternative", "seen live"]
+        for feature in FEATURES:
+            setattr(analyzed_track, feature, random.random())
+        analyzed_track.mode = analyzed_track.key = analyzed_track.time_signature = 1
+        if cls is PlainTrack:
+            analyzed_track.pitches = encode_pitches(track_starts, track_values)
+        else:
+            analyzed_track.set_pitches(track_starts, track_values)
+        analyzed.append(analyzed_track)
+    return analyzed
+
+
+def measure(cls, page) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    start = perf_counter()
+    analyzed = build(cls, page)
+    built = perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = perf_counter()
+    for track in analyzed:
+        track.to_document()
+    serialised = perf_counter() - start
+    start = perf_counter()
+    for track in analyzed:
+        repr(track)
+    represented = perf_counter() - start
+    payload = sum(starts.nbytes + values.nbytes for starts, values in zip(page[2], page[3]))
+    return {"memory": memory / len(analyzed), "overhead": (memory - payload) / len(analyzed),
+            "build": built, "to_document": serialised, "repr": represented}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the memory of slotted and plain tracks")
+    parser.add_argument("--tracks", type=int, default=5000)
+    parser.add_argument("--segments", type=int, default=800, help="pitch segments per track")
+    args = parser.parse_args()
+    random.seed(42)
+    np.random.seed(42)
+    page = fake_page(args.tracks, args.segments)
+    print(f"{'track':>14} {'bytes/track':>12} {'without pitches':>16} {'build [s]':>10} {'to_document [s]':>16} "
+          + f"{'repr [s]':>9}")
+    for cls in [PlainTrack, AnalyzedTrack]:
+        result = measure(cls, page)
+        print(f"{cls.__name__:>14} {result['memory']:>12.0f} {result['overhead']:>16.0f} {result['build']:>10.3f} "
+              + f"{result['to_document']:>16.3f} {result['repr']:>9.3f}")
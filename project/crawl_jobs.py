@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+from typing import List, Dict
+
+
+class CrawlJob:
+    """
+    Progress of a playlist crawl. offset is the next page to fetch, pending holds the ids of tracks
+    that were fetched but are not saved yet.
+    """
+    playlist_id: str
+    offset: int
+    pending: List[str]
+    done: bool
+
+    def __init__(self, playlist_id: str, offset: int = 0, pending: List[str] = None, done: bool = False):
+        self.playlist_id = playlist_id
+        self.offset = offset
+        self.pending = pending if pending is not None else []
+        self.done = done
+
+    def to_dict(self) -> dict:
+        return {"playlist_id": self.playlist_id, "offset": self.offset, "pending": self.pending, "done": self.done}
+
+    @staticmethod
+    def from_dict(job: dict) -> "CrawlJob":
+        return CrawlJob(job["playlist_id"], job["offset"], job["pending"], job["done"])
+
+    def __repr__(self):
+        return f"CrawlJob(playlist_id={self.playlist_id}, " \
+               + f"offset={self.offset}, " \
+               + f"pending={len(self.pending)}, " \
+               + f"done={self.done})"
+
+
+class CrawlJobStore:
+    """
+    Queue of playlist crawls persisted to a json file after every change, so a restarted crawler
+    continues where it stopped
+    """
+    path: str
+    jobs: Dict[str, CrawlJob]
+
+    def __init__(self, path: str = ".crawl_jobs.json"):
+        self.path = path
+        self.jobs = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as infile:
+                self.jobs = {job["playlist_id"]: CrawlJob.from_dict(job) for job in json.load(infile)}
+
+    def enqueue(self, playlist_ids: List[str]):
+        with self._lock:
+            for playlist_id in playlist_ids:
+                if playlist_id not in self.jobs:
+                    self.jobs[playlist_id] = CrawlJob(playlist_id)
+            self._save()
+
+    def unfinished(self) -> List[CrawlJob]:
+        with self._lock:
+            return [job for job in self.jobs.values() if not job.done]
+
+    def page_started(self, playlist_id: str, next_offset: int, track_ids: List[str]):
+        with self._lock:
+            job = self.jobs[playlist_id]
+            job.offset = next_offset
+            job.pending.extend(track_id for track_id in track_ids if track_id not in job.pending)
+            self._save()
+
+    def page_finished(self, playlist_id: str, track_ids: List[str]):
+        with self._lock:
+            finished = set(track_ids)
+            job = self.jobs[playlist_id]
+            job.pending = [track_id for track_id in job.pending if track_id not in finished]
+            self._save()
+
+    def finish(self, playlist_id: str):
+        with self._lock:
+            self.jobs[playlist_id].done = True
+            self._save()
+
+    def _save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as outfile:
+            json.dump([job.to_dict() for job in self.jobs.values()], outfile, indent=4)
+        os.replace(temporary_path, self.path)
@@ -1,4 +1,8 @@
+import argparse
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
 import certifi
 import tekore as tk
@@ -7,41 +11,229 @@ import httpx
 import json
 
 from pymongo.collection import Collection
-from tekore import Spotify, Credentials, NotFound, TooManyRequests
+from pymongo.database import Database
+from tekore import Spotify, Credentials, NotFound
 
 from authentication.spotify_server import SpotifyServer
-from typing import List
+from typing import List, Optional
 
+from project.artist_cache import ArtistCache
+from project.crawl_jobs import CrawlJob, CrawlJobStore
+from project.metrics import METRICS, MeteredSender, configure_logging
+from project.pitches import segment_arrays
+from project.pipeline import Pipeline, Stage
 from project.playlist_tracks import PlaylistTracks
-from project.random_tracks import RandomTracks
-from project.util import Partition
+from project.random_tracks import RandomTracks, stored_track_ids
+from project.rate_limit import HostLimiter, CircuitOpenError, limiter_for
+from project.tag_resolver import TagResolver
+from project.util import Partition, index_by_id
 import pylast
 from authentication.lastfm_credentials import LastFmCredentials
 from lastfm import LastFmScraper, LastFmProxy
+from lastfm.cache import TagCache
 import track as model
 from project.track import TaggedTrack
-from time import sleep
 from pymongo.server_api import ServerApi
 from pymongo import MongoClient
 
+logger = logging.getLogger(__name__)
+
+
+def connect_database() -> Database:
+    mongo_uri = os.environ.get("MONGO_URL")
+    mongo_certificate = os.environ.get("MONGO_CERTIFICATE")
+    client = MongoClient(mongo_uri,
+                         tls=True,
+                         tlsCAFile=certifi.where(),
+                         tlsCertificateKeyFile=mongo_certificate,
+                         server_api=ServerApi('1'))
+    return client['spotifai']
+
+
+def load_spotify_token(path: str = ".spotify_credentials.json") -> tk.Token:
+    with open(path, "r") as infile:
+        token_dict = json.load(infile)
+        token_dict["scope"] = " ".join(token_dict["scope"])
+        return tk.Token(token_dict, token_dict["uses_pkce"])
+
+
+def store_spotify_token(token: tk.Token, path: str = ".spotify_credentials.json"):
+    scopes: List[str] = list(token.scope)
+    token_dict = {
+        "token_type": token.token_type,
+        "access_token": token.access_token,
+        "refresh_token": token.refresh_token,
+        "scope": scopes[0].replace("[", "").replace("]", "").replace("'", "").split(", ") if len(
+            scopes) == 0 else scopes,
+        "expires_at": token.expires_at,
+        "uses_pkce": token.uses_pkce,
+        "expires_in": 0
+    }
+    json_object = json.dumps(token_dict, indent=4)
+    with open(path, "w") as outfile:
+        outfile.write(json_object)
+
+
+def enrich_track(track: model.AnalyzedTrack, feature, analysis):
+    """
+    Copy the audio features and the pitches of the analysis onto the track,
+    the track is left untouched if either of them is missing
+    """
+    if analysis is None or feature is None:
+        return
+    track.acousticness = feature.acousticness
+    track.set_pitches(*segment_arrays(analysis.segments))
+    track.loudness = feature.loudness
+    track.energy = feature.energy
+    track.danceability = feature.danceability
+    track.mode = feature.mode
+    track.instrumentalness = feature.instrumentalness
+    track.key = feature.key
+    track.liveness = feature.liveness
+    track.tempo = feature.tempo
+    track.time_signature = feature.time_signature
+    track.valence = feature.valence
+
+
+def enrich_tracks(tracks: List[model.AnalyzedTrack], features: List[list], analyses: list):
+    """
+    :param features: audio features of the tracks in chunks, in any order
+    :param analyses: audio analysis of every track, None if it could not be retrieved
+    """
+    features_by_id = index_by_id([feature for partition in features for feature in partition])
+    for track, analysis in zip(tracks, analyses):
+        enrich_track(track, features_by_id.get(track.id), analysis)
+
+
+ANALYSIS_ERRORS = (httpx.HTTPError, tk.HTTPError, CircuitOpenError)
+
+
+def analysis_failed(track_id: str, error: Exception):
+    """
+    Count and log an audio analysis that could not be retrieved, one of ANALYSIS_ERRORS
+    """
+    if isinstance(error, NotFound):
+        METRICS.increment("missing_audio_analyses")
+        logger.info("track %s does not have audio analysis: %s", track_id, error)
+    else:
+        METRICS.increment("failed_audio_analyses")
+        logger.warning("audio analysis of track %s failed: %s", track_id, error)
+
+
+def set_tags(tracks: List[model.AnalyzedTrack], tags: List[List[str]]):
+    """
+    Tracks without tags keep None
+    """
+    for track, track_tags in zip(tracks, tags):
+        if len(track_tags) == 0:
+            METRICS.increment("tracks_without_tags")
+            logger.debug("no tags %s %s %s", track.id, track.name, track.artist_names)
+            continue
+        track.tags = track_tags
+
+
+def save_tracks(collection: Collection, analyzed_tracks: model.AnalyzedTracks,
+                tag_resolver: Optional[TagResolver] = None):
+    """
+    :param tag_resolver: also store the ids of the allowed tags of the tracks
+    """
+    logger.info("saving %d tracks", len(analyzed_tracks.tracks))
+    if tag_resolver is not None:
+        tagged_tracks = [track for track in analyzed_tracks.tracks if track.tags is not None]
+        tag_ids = tag_resolver.resolve_many([track.tags for track in tagged_tracks])
+        for track, track_tag_ids in zip(tagged_tracks, tag_ids):
+            track.tag_ids = track_tag_ids
+    for summary in analyzed_tracks.upsert(collection):
+        METRICS.increment("tracks_upserted", summary.upserted)
+        METRICS.increment("tracks_modified", summary.modified)
+        METRICS.increment("write_errors", len(summary.errors))
+        logger.info("%s", summary, extra={"batch": summary.batch, "upserted": summary.upserted,
+                                          "modified": summary.modified, "errors": len(summary.errors)})
+
+
+class ArtistRounds:
+    """
+    Artists of tracks that are missing from an ArtistCache, requested in chunks. Chunks that fail with a server
+    error or an open circuit are requested again in the next round, the error is raised once max_retries rounds
+    failed. The requests are left to the caller.
+    """
+    cache: ArtistCache
+    max_retries: int
+    pending: List[List[str]]
+    failed_rounds: int
+
+    def __init__(self, cache: ArtistCache, tracks: list, max_retries: int):
+        self.cache = cache
+        self.max_retries = max_retries
+        self.failed_rounds = 0
+        self._artist_ids = [artist.id for track in tracks for artist in track.artists]
+        self.pending = list(Partition(cache.missing(self._artist_ids)))
+
+    def add(self, results: list):
+        """
+        :param results: artists of every pending chunk or the exception raised by its request
+        """
+        failed = []
+        for ids, result in zip(self.pending, results):
+            if isinstance(result, (tk.ServerError, CircuitOpenError)):
+                logger.warning("error retrieving artists: %s", result)
+                failed.append(ids)
+                error = result
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                self.cache.put_many(result)
+        self.pending = failed
+        if len(failed) > 0:
+            if self.failed_rounds >= self.max_retries:
+                raise error
+            self.failed_rounds += 1
+
+    def artists(self) -> list:
+        return self.cache.get_many(self._artist_ids)
+
 
 def refresh_token(func):
     """
     Decorator that refreshes the spotify token
     """
 
+    @wraps(func)
     def wrap(*args, **kwargs):
         self: Crawler = args[0]
         token: tk.Token = self._spotify.token
         if token.is_expiring:
             self._spotify.token = self._cred.refresh(self._spotify.token)
-            print("refreshing spotify credentials at", func.__name__)
+            METRICS.increment("token_refreshes")
+            logger.info("refreshed spotify credentials at %s", func.__name__)
         result = func(*args, **kwargs)
         return result
 
     return wrap
 
 
+class CrawlPage:
+    """
+    Page of tracks travelling through the stages of the crawl pipeline
+    """
+    tracks: list
+    artists: list
+    analyzed_tracks: Optional[model.AnalyzedTracks]
+    playlist_id: Optional[str]
+    track_ids: List[str]
+
+    def __init__(self, tracks: list, playlist_id: Optional[str] = None, track_ids: Optional[List[str]] = None):
+        """
+        :param playlist_id: playlist job the page belongs to
+        :param track_ids: ids the page was requested with, the ids of the tracks by default
+        """
+        self.tracks = tracks
+        self.artists = []
+        self.analyzed_tracks = None
+        self.playlist_id = playlist_id
+        self.track_ids = track_ids if track_ids is not None else [track.id for track in tracks]
+
+
 class Crawler:
     _host: str
     _port: int
@@ -50,178 +242,258 @@ class Crawler:
     _conf: tuple
     _cred: Credentials
     _track_collection: Collection
-
-    def __init__(self, host: str, port: int) -> None:
+    _analysis_concurrency: int
+    _artist_concurrency: int
+    _spotify_limiter: HostLimiter
+    _artist_cache: ArtistCache
+    _tag_resolver: Optional[TagResolver]
+    _jobs: Optional[CrawlJobStore]
+
+    def __init__(self, host: str, port: int,
+                 analysis_concurrency: int = 8,
+                 artist_concurrency: int = 4,
+                 artist_cache_path: Optional[str] = None,
+                 resolve_tags: bool = False,
+                 spotify: Optional[Spotify] = None,
+                 lastfm: Optional[LastFmProxy] = None,
+                 database: Optional[Database] = None) -> None:
+        """
+        :param spotify: client with a valid token, skips loading and storing the spotify credentials
+        :param lastfm: proxy used for tags instead of the scraper of www.last.fm
+        :param database: database used instead of the one configured by MONGO_URL
+        """
         self._host = host
         self._port = port
+        self._analysis_concurrency = analysis_concurrency
+        self._artist_concurrency = artist_concurrency
+        self._spotify_limiter = limiter_for("api.spotify.com")
+        self._artist_cache = ArtistCache(artist_cache_path)
+        self._jobs = None
 
         load_dotenv()
 
         conf = tk.config_from_environment()
         self._cred = tk.Credentials(*conf)
 
-        creds = LastFmCredentials()
-
-        self._spotify = tk.Spotify()
-        last_network = pylast.LastFMNetwork(
-            api_key=creds.api_key,
-            api_secret=creds.shared_secret,
-        )
-
-        self._lastfm = LastFmProxy(last_network, LastFmScraper(), scraper_only=True)
-
-        self._set_spotify_credentials()
-        self._store_spotify_credentials()
-        mongo_uri = os.environ.get("MONGO_URL")
-        mongo_certificate = os.environ.get("MONGO_CERTIFICATE")
-        client = MongoClient(mongo_uri,
-                             tls=True,
-                             tlsCAFile=certifi.where(),
-                             tlsCertificateKeyFile=mongo_certificate,
-                             server_api=ServerApi('1'))
-        db = client['spotifai']
+        if lastfm is None:
+            creds = LastFmCredentials()
+            last_network = pylast.LastFMNetwork(
+                api_key=creds.api_key,
+                api_secret=creds.shared_secret,
+            )
+            lastfm = LastFmProxy(last_network, LastFmScraper(), scraper_only=True, cache=TagCache())
+        self._lastfm = lastfm
+
+        if spotify is None:
+            self._spotify = tk.Spotify(sender=MeteredSender())
+            self._set_spotify_credentials()
+            self._store_spotify_credentials()
+        else:
+            self._spotify = spotify
+        db = database if database is not None else connect_database()
         self._track_collection = db['tracks']
+        self._track_collection.create_index("id")
+        self._tag_resolver = TagResolver.from_collection(db['allowed_tags']) if resolve_tags else None
 
-    def collect_tracks_from_playlist(self, playlist_id: str, offset: int = 0):
+    def collect_tracks_from_playlist(self, playlist_id: str, offset: int = 0, pipelined: bool = False):
         self._spotify.token = self._cred.refresh(self._spotify.token)
         track_generator = self._retrieve_playlist_tracks(playlist_id, offset)
 
-        for tracks in track_generator:
-            analyzed_tracks = self._analyze_tracks(tracks)
-            self._save_tracks(analyzed_tracks)
-
-    def collect_random_tracks(self):
-        tracks = self._retrieve_random_tracks()
-        analyzed_tracks = self._analyze_tracks(tracks)
-        self._save_tracks(analyzed_tracks)
-
-    def _save_tracks(self, analyzed_tracks):
-        print("Saving tracks ...")
-        analyzed_tracks.upsert(self._track_collection)
+        try:
+            self._crawl_pages((CrawlPage(tracks) for tracks in track_generator), pipelined)
+        finally:
+            self._artist_cache.save()
+
+    def collect_playlists(self, playlist_ids: List[str], jobs: Optional[CrawlJobStore] = None,
+                          pipelined: bool = False):
+        """
+        Crawl a queue of playlists. The progress of every playlist is persisted, after a restart finished pages
+        are skipped and only the tracks that were still pending get fetched again.
+        """
+        self._jobs = jobs if jobs is not None else CrawlJobStore()
+        self._jobs.enqueue(playlist_ids)
+        try:
+            for job in self._jobs.unfinished():
+                logger.info("crawling %s", job, extra={"playlist_id": job.playlist_id})
+                self._spotify.token = self._cred.refresh(self._spotify.token)
+                self._crawl_pages(self._job_pages(job), pipelined)
+                self._jobs.finish(job.playlist_id)
+        finally:
+            self._jobs = None
+            self._artist_cache.save()
+
+    def collect_pages(self, pages, pipelined: bool = False):
+        """
+        Crawl pages that were fetched elsewhere, e.g. by a distributed worker
+        :param pages: iterable of CrawlPage
+        """
+        try:
+            self._crawl_pages(pages, pipelined)
+        finally:
+            self._artist_cache.save()
 
-    def _analyze_tracks(self, tracks) -> model.AnalyzedTracks:
-        print("Analyzing", len(tracks), "tracks ...")
-        artists = self._retrieve_artists(tracks)
+    def playlist_total(self, playlist_id: str) -> int:
+        return self._spotify_limiter.call(self._spotify.playlist_items, playlist_id, limit=1).total
 
-        analyzed_tracks = model.AnalyzedTracks(tracks, artists)
-        self._retrieve_tags(analyzed_tracks.tracks)
-        self._enrich_tracks(analyzed_tracks.tracks)
+    def playlist_range_pages(self, playlist_id: str, offset: int = 0, end: Optional[int] = None):
+        """
+        :return: generator of the pages of the playlist between offset and end, up to the last page if end is None
+        """
+        playlist_tracks = PlaylistTracks(self._spotify, self._cred)
+        for _, tracks in playlist_tracks.playlist_pages(playlist_id, offset, end):
+            yield CrawlPage(tracks, playlist_id)
+
+    def track_pages(self, track_ids: List[str], playlist_id: Optional[str] = None):
+        """
+        :return: generator of pages of the given tracks, ids spotify does not know are skipped
+        """
+        for ids in Partition(list(track_ids)):
+            tracks = [track for track in self._spotify_limiter.call(self._spotify.tracks, ids)
+                      if track is not None]
+            yield CrawlPage(tracks, playlist_id, ids)
+
+    def _job_pages(self, job: CrawlJob):
+        yield from self.track_pages(job.pending, job.playlist_id)
+        for offset, tracks in self._retrieve_playlist_pages(job.playlist_id, job.offset):
+            page = CrawlPage(tracks, job.playlist_id)
+            self._jobs.page_started(job.playlist_id, offset + PlaylistTracks.limit, page.track_ids)
+            yield page
+
+    def _crawl_pages(self, pages, pipelined: bool):
+        if pipelined:
+            self._run_pipeline(pages)
+            return
+
+        for page in pages:
+            self._save_stage(self._enrich_stage(self._tags_stage(self._artists_stage(page))))
+
+    def _run_pipeline(self, pages, queue_size: int = 2):
+        """
+        Runs the crawl stages concurrently, page N+1 is fetched while page N is tagged and page N-1 is saved
+        """
+        pipeline = Pipeline([
+            Stage("artists", self._artists_stage),
+            Stage("tags", self._tags_stage),
+            Stage("enrich", self._enrich_stage),
+            Stage("save", self._save_stage),
+        ], queue_size=queue_size)
+        try:
+            pipeline.run(pages)
+        finally:
+            logger.info("pipeline stages\n%s", pipeline.report())
+
+    def _artists_stage(self, page: CrawlPage) -> CrawlPage:
+        logger.info("analyzing %d tracks", len(page.tracks), extra={"tracks": len(page.tracks)})
+        METRICS.increment("tracks_analyzed", len(page.tracks))
+        page.artists = self._retrieve_artists(page.tracks)
+        return page
+
+    def _tags_stage(self, page: CrawlPage) -> CrawlPage:
+        page.analyzed_tracks = model.AnalyzedTracks(page.tracks, page.artists)
+        self._retrieve_tags(page.analyzed_tracks.tracks)
+        return page
+
+    def _enrich_stage(self, page: CrawlPage) -> CrawlPage:
+        self._enrich_tracks(page.analyzed_tracks.tracks)
+        return page
+
+    def _save_stage(self, page: CrawlPage) -> CrawlPage:
+        self._save_tracks(page.analyzed_tracks)
+        if self._jobs is not None and page.playlist_id is not None:
+            self._jobs.page_finished(page.playlist_id, page.track_ids)
+        return page
+
+    def collect_random_tracks(self, count: int = 50, pipelined: bool = False):
+        """
+        Sample count random tracks that are not stored yet
+        """
+        random_tracks = RandomTracks(self._spotify, self._cred)
+        seen = stored_track_ids(self._track_collection)
+        try:
+            self._crawl_pages((CrawlPage(tracks) for tracks in random_tracks.sample(count, seen)), pipelined)
+        finally:
+            logger.info("%s", random_tracks.stats)
+            self._artist_cache.save()
 
-        return analyzed_tracks
+    @METRICS.timed()
+    def _save_tracks(self, analyzed_tracks):
+        save_tracks(self._track_collection, analyzed_tracks, self._tag_resolver)
 
     def _set_spotify_credentials(self):
         try:
-            with open(".spotify_credentials.json", "r") as infile:
-                token_dict = json.load(infile)
-                token_dict["scope"] = " ".join(token_dict["scope"])
-                self._spotify.token = tk.Token(token_dict, token_dict["uses_pkce"])
-                self._spotify.token = self._cred.refresh(self._spotify.token)
+            self._spotify.token = self._cred.refresh(load_spotify_token())
         except Exception as e:
-            print(e)
+            logger.warning("could not refresh the stored spotify token: %s", e)
             app = SpotifyServer(self._host, self._port, self._spotify, self._cred)
             self._spotify.token = app.spawn_single_use_server()
 
     def _store_spotify_credentials(self):
-        token: tk.Token = self._spotify.token
-        scopes: List[str] = list(token.scope)
-        token_dict = {
-            "token_type": token.token_type,
-            "access_token": token.access_token,
-            "refresh_token": token.refresh_token,
-            "scope": scopes[0].replace("[", "").replace("]", "").replace("'", "").split(", ") if len(
-                scopes) == 0 else scopes,
-            "expires_at": token.expires_at,
-            "uses_pkce": token.uses_pkce,
-            "expires_in": 0
-        }
-        json_object = json.dumps(token_dict, indent=4)
-        with open(".spotify_credentials.json", "w") as outfile:
-            outfile.write(json_object)
-
-    def _retrieve_random_tracks(self):
-        random_tracks = RandomTracks(self._spotify, self._cred)
-        return random_tracks.random_tracks()
+        store_spotify_token(self._spotify.token)
 
+    @METRICS.timed()
     def _retrieve_artists(self, tracks):
-        artist_ids = [artist.id for track in tracks
-                      for artist in track.artists]
-        artist_id_partitions = Partition(artist_ids)
-        pending = True
-        while pending:
-            try:
-                artists = [self._spotify.artists(ids) for ids in artist_id_partitions]
-                pending = False
-            except tk.ServerError as se:
-                print("Error retrieving artists:", se)
-                pending = True
-        artists = list(artist for partition in artists for artist in partition)
-        return artists
-
+        rounds = ArtistRounds(self._artist_cache, tracks, self._spotify_limiter.policy.max_retries)
+        while len(rounds.pending) > 0:
+            with ThreadPoolExecutor(max_workers=self._artist_concurrency) as executor:
+                requests = [executor.submit(self._spotify_limiter.call, self._spotify.artists, ids)
+                            for ids in rounds.pending]
+            rounds.add([request.exception() or request.result() for request in requests])
+            if len(rounds.pending) > 0:
+                self._spotify_limiter.backoff(rounds.failed_rounds - 1)
+        return rounds.artists()
+
+    @METRICS.timed()
     def _retrieve_tags(self, tracks):
-        for track in tracks:
-            try:
-                tags = TaggedTrack(self._lastfm, track.name, track.artist_names).tags()
-                if len(tags) == 0:
-                    raise Exception("No tags")
-            except Exception as e:
-                print(e, track.id, track.name, track.artist_names)
-                continue
-            track.tags = tags
+        tagged_tracks = [TaggedTrack(self._lastfm, track.name, track.artist_names) for track in tracks]
+        try:
+            tags = TaggedTrack.tags_many(self._lastfm, tagged_tracks)
+        except Exception as e:
+            logger.warning("error retrieving tags: %s", e)
+            return
+        set_tags(tracks, tags)
 
+    @METRICS.timed()
     @refresh_token
     def _enrich_tracks(self, tracks):
         track_ids = [track.id for track in tracks]
         track_id_partitions = Partition(track_ids)
-        features = [self._spotify.tracks_audio_features(ids) for ids in track_id_partitions]
-        features = [feature for partition in features for feature in partition]
-
-        for track in tracks:
-            successful = False
-            analysis = None
-            retries_404 = 0
-            while not successful:
-                try:
-                    analysis = self._spotify.track_audio_analysis(track_id=track.id)
-                    successful = True
-                except httpx.HTTPError:
-                    print("Retry of audio analysis for track", track.id, "necessary.")
-                    successful = False
-                    sleep(4)
-                except NotFound as nf:
-                    if retries_404 >= 5:
-                        successful = True
-                        print("Track", track.id, "does not have audio analysis:", nf)
-                    else:
-                        retries_404 += 1
-                        print("Could not find analysis for", track.id, "trying again: ", retries_404, "/5")
-                except TooManyRequests:
-                    print("Too many requests, waiting 30s...")
-                    sleep(30)
-            if analysis is None:
-                continue
-            matching_features = [feature for feature in features if feature is not None and feature.id == track.id]
-            if len(matching_features) == 0:
-                continue
-            feature = matching_features[0]
-            track.acousticness = feature.acousticness
-            track.pitches = {str(segment.start): [p for p in segment.pitches] for segment in analysis.segments}
-            track.loudness = feature.loudness
-            track.energy = feature.energy
-            track.danceability = feature.danceability
-            track.mode = feature.mode
-            track.instrumentalness = feature.instrumentalness
-            track.key = feature.key
-            track.liveness = feature.liveness
-            track.tempo = feature.tempo
-            track.time_signature = feature.time_signature
-            track.valence = feature.valence
+        features = [self._spotify_limiter.call(self._spotify.tracks_audio_features, ids)
+                    for ids in track_id_partitions]
+
+        with ThreadPoolExecutor(max_workers=self._analysis_concurrency) as executor:
+            analyses = list(executor.map(self._retrieve_audio_analysis, track_ids))
+
+        enrich_tracks(tracks, features, analyses)
+
+    def _retrieve_audio_analysis(self, track_id: str):
+        try:
+            return self._spotify_limiter.call(self._spotify.track_audio_analysis, track_id=track_id,
+                                              not_found_retries=5)
+        except ANALYSIS_ERRORS as e:
+            analysis_failed(track_id, e)
+        return None
 
     @refresh_token
     def _retrieve_playlist_tracks(self, playlist_id: str, offset: int):
         playlist_tracks = PlaylistTracks(self._spotify, self._cred)
         return playlist_tracks.playlist_tracks(playlist_id, offset)
 
+    @refresh_token
+    def _retrieve_playlist_pages(self, playlist_id: str, offset: int):
+        playlist_tracks = PlaylistTracks(self._spotify, self._cred)
+        return playlist_tracks.playlist_pages(playlist_id, offset)
+
 
 if __name__ == "__main__":
-    crawler = Crawler("127.0.0.1", 5000)
-    crawler.collect_tracks_from_playlist("2rcMRS9fDOnuu5YUTXAcQZ")
+    parser = argparse.ArgumentParser(description="Crawl spotify playlists, progress is kept in .crawl_jobs.json")
+    parser.add_argument("playlist_ids", nargs="*", default=["2rcMRS9fDOnuu5YUTXAcQZ"])
+    parser.add_argument("--metrics", help="write the metrics of the crawl to this file, .json or Prometheus text")
+    parser.add_argument("--log-json", action="store_true", help="log json lines")
+    args = parser.parse_args()
+    configure_logging(structured=args.log_json)
+    crawler = Crawler("127.0.0.1", 5000, artist_cache_path=".spotify_artists.pickle")
+    try:
+        crawler.collect_playlists(args.playlist_ids, pipelined=True)
+    finally:
+        if args.metrics is not None:
+            METRICS.dump(args.metrics)
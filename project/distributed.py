@@ -0,0 +1,195 @@
+import argparse
+import logging
+import os
+import socket
+import threading
+from multiprocessing import Process
+from time import sleep
+from typing import Optional, Union
+
+from pymongo import MongoClient
+
+from project.crawler import Crawler, connect_database
+from project.fake_spotify import fake_spotify, RedirectSession
+from project.metrics import configure_logging
+from project.rate_limit import limiter_for
+from project.replay import SqliteDatabase
+from project.work_queue import Lease, LocalLeaseQueue, MongoLeaseQueue
+from lastfm import LastFmProxy, LastFmScraper
+
+WorkQueue = Union[LocalLeaseQueue, MongoLeaseQueue]
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    """
+    Raised when a lease expired and was taken over by another worker while it was being processed
+    """
+
+
+class CrawlWorker:
+    """
+    Claims tasks from a work queue and runs them through the stages of the crawler, failed tasks are
+    handed back to the queue. While a task is processed its lease is renewed in the background, a lease that
+    was lost stops the task before its next page. With a rate budget the spotify requests per second are
+    split evenly between all active workers.
+    """
+    crawler: Crawler
+    queue: WorkQueue
+    worker_id: str
+    rate_budget: Optional[float]
+    poll_interval: float
+    pipelined: bool
+
+    def __init__(self, crawler: Crawler, queue: WorkQueue, worker_id: Optional[str] = None,
+                 rate_budget: Optional[float] = None, poll_interval: float = 5, pipelined: bool = False):
+        """
+        :param rate_budget: spotify requests per second of all workers together
+        :param poll_interval: seconds to wait before asking again when no task is available
+        """
+        self.crawler = crawler
+        self.queue = queue
+        self.worker_id = worker_id if worker_id is not None else f"{socket.gethostname()}-{os.getpid()}"
+        self.rate_budget = rate_budget
+        self.poll_interval = poll_interval
+        self.pipelined = pipelined
+
+    def run(self, wait: bool = False) -> int:
+        """
+        Process tasks until the queue is finished
+        :param wait: keep polling for new tasks instead of returning once the queue is finished
+        :return: number of completed tasks
+        """
+        completed = 0
+        while True:
+            lease = self.queue.claim(self.worker_id)
+            self._share_rate_budget()
+            if lease is None:
+                if not wait and self.queue.unfinished() == 0:
+                    return completed
+                sleep(self.poll_interval)
+                continue
+            logger.info("%s claimed %s", self.worker_id, lease, extra={"worker_id": self.worker_id})
+            if self._process(lease):
+                completed += 1
+
+    def _process(self, lease: Lease) -> bool:
+        finished = threading.Event()
+        lost = threading.Event()
+        keep_alive = threading.Thread(target=self._keep_alive, args=(lease, finished, lost), daemon=True)
+        keep_alive.start()
+        try:
+            self.crawler.collect_pages(self._pages(lease, lost), self.pipelined)
+        except Exception as e:
+            logger.warning("%s failed %s: %s", self.worker_id, lease, e, extra={"worker_id": self.worker_id})
+            self.queue.release(lease, repr(e))
+            return False
+        finally:
+            finished.set()
+            keep_alive.join()
+        self.queue.complete(lease)
+        return True
+
+    def _keep_alive(self, lease: Lease, finished: threading.Event, lost: threading.Event):
+        """
+        Renew the lease a few times per lease period until the task is finished
+        """
+        while not finished.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(lease):
+                lost.set()
+                return
+            self._share_rate_budget()
+
+    def _pages(self, lease: Lease, lost: threading.Event):
+        if len(lease.track_ids) > 0:
+            pages = self.crawler.track_pages(lease.track_ids)
+        else:
+            pages = self.crawler.playlist_range_pages(lease.playlist_id, lease.offset, lease.end)
+        for page in pages:
+            if lost.is_set():
+                raise LeaseLost(f"{lease} was taken over by another worker")
+            yield page
+
+    def _share_rate_budget(self):
+        if self.rate_budget is None:
+            return
+        limiter_for("api.spotify.com").bucket.set_rate(self.rate_budget / max(1, self.queue.active_workers()))
+
+
+def create_queue(args) -> WorkQueue:
+    if args.mongo_queue is not None:
+        return MongoLeaseQueue(mongo_database(args)[args.mongo_queue], lease_seconds=args.lease_seconds)
+    return LocalLeaseQueue(args.queue, lease_seconds=args.lease_seconds)
+
+
+def mongo_database(args):
+    if args.mongo_url is not None:
+        return MongoClient(args.mongo_url)['spotifai']
+    return connect_database()
+
+
+def create_database(args):
+    """
+    Database of the crawled tracks, crawls of a fake server are stored in the sqlite file of --sqlite
+    unless --mongo-url is given
+    """
+    if args.fake is not None and args.mongo_url is None:
+        return SqliteDatabase(args.sqlite)
+    return mongo_database(args)
+
+
+def create_crawler(args) -> Crawler:
+    if args.fake is None:
+        return Crawler("127.0.0.1", 5000, database=create_database(args))
+    lastfm = LastFmProxy(None, LastFmScraper(session=RedirectSession(args.fake)), scraper_only=True)
+    return Crawler("127.0.0.1", 5000, spotify=fake_spotify(args.fake), lastfm=lastfm, database=create_database(args))
+
+
+def seed(args):
+    queue = create_queue(args)
+    if args.fake is not None:
+        spotify = fake_spotify(args.fake)
+        totals = {playlist_id: spotify.playlist_items(playlist_id, limit=1).total for playlist_id in args.playlist_ids}
+    else:
+        crawler = create_crawler(args)
+        totals = {playlist_id: crawler.playlist_total(playlist_id) for playlist_id in args.playlist_ids}
+    for playlist_id, total in totals.items():
+        print("queued", queue.add_playlist(playlist_id, total, args.range_size), "ranges of playlist", playlist_id)
+
+
+def work(args):
+    configure_logging()
+    worker = CrawlWorker(create_crawler(args), create_queue(args), rate_budget=args.rate_budget,
+                         pipelined=args.pipelined)
+    print(worker.worker_id, "completed", worker.run(wait=args.wait), "tasks")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl playlists with several workers sharing a work queue")
+    parser.add_argument("--queue", default=".crawl_queue.sqlite", help="sqlite queue shared by local workers")
+    parser.add_argument("--mongo-queue", help="collection of a queue shared by workers on several machines")
+    parser.add_argument("--mongo-url", help="plain mongo url instead of MONGO_URL and MONGO_CERTIFICATE")
+    parser.add_argument("--fake", help="url of a fake spotify server, see fake_spotify.py")
+    parser.add_argument("--sqlite", default=".crawl_tracks.sqlite",
+                        help="tracks of --fake crawls without --mongo-url, shared by local workers")
+    parser.add_argument("--lease-seconds", type=float, default=300)
+    commands = parser.add_subparsers(dest="command", required=True)
+    seed_parser = commands.add_parser("seed", help="split playlists into ranges and queue them")
+    seed_parser.add_argument("playlist_ids", nargs="+")
+    seed_parser.add_argument("--range-size", type=int, default=500)
+    worker_parser = commands.add_parser("worker", help="process queued ranges")
+    worker_parser.add_argument("--processes", type=int, default=1)
+    worker_parser.add_argument("--rate-budget", type=float, help="spotify requests per second of all workers")
+    worker_parser.add_argument("--pipelined", action="store_true")
+    worker_parser.add_argument("--wait", action="store_true", help="keep waiting for new tasks")
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        seed(args)
+    else:
+        processes = [Process(target=work, args=(args,)) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -1,14 +1,30 @@
+import argparse
 import certifi
+import hashlib
+import json
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import sleep
 
+import bson
+from bson import json_util
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
 from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
 from pymongo.server_api import ServerApi
+import numpy as np
 import pandas as pd
 from typing import List
 from typing import Dict
+from typing import Optional
+from typing import Any
+from typing import Tuple
 
+from pitches import decode_pitches, resample, PITCH_CLASSES
+from tag_resolver import TagResolver
+from song_writer import CsvSongWriter, ParquetSongWriter
 
 load_dotenv()
 
@@ -21,88 +37,304 @@ client = MongoClient(mongo_uri,
                      server_api=ServerApi('1'))
 db = client['spotifai']
 
-track_collection = db["preprocessed_tracks"]
 
 pitch_symbol = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+resampled_steps = 100
+exported_fields = ["id", "name", "duration", "artist_genres", "artist_names", "acousticness", "pitches", "loudness",
+                   "energy", "danceability", "mode", "instrumentalness", "key", "liveness", "tempo",
+                   "time_signature", "valence", "tags"]
 
 
-def tolower(s: str):
-    return s.lower()
+class ExportCheckpoint:
+    """
+    Remembers the _id of the last exported track, so an interrupted export can resume after it
+    """
+    path: str
 
+    def __init__(self, path: str = ".export_checkpoint.json"):
+        self.path = path
 
-def flatmap(list_of_lists):
-    return [item for inner_list in list_of_lists for item in inner_list]
+    def load(self) -> Optional[Any]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r") as infile:
+            return json_util.loads(infile.read())["last_id"]
 
+    def save(self, last_id: Any):
+        with open(self.path, "w") as outfile:
+            outfile.write(json_util.dumps({"last_id": last_id}))
 
-def tracks(collection: Collection, offset=0, limit=400):
-    loading = True
-    try:
-        while loading:
-            print("fetching tracks with offset", offset)
-            docs = collection.find({}, allow_disk_use=True)\
-                .skip(offset)\
-                .limit(limit)
-            current_track_data = [doc for doc in docs]
-            loading = len(current_track_data) != 0
-            yield current_track_data
-            offset += limit
-    except Exception as e:
-        print(e)
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 
-def pitch_trans(p):
-    pitch_frequency = list()
-    for timestamp in p:
-        pitch_dict = {"timestamp": float(timestamp)}
-        for i in range(0, len(p[timestamp])):
-            pitch_dict[pitch_symbol[i]] = p[timestamp][i]
-        pitch_frequency.append(pitch_dict)
-    return pitch_frequency
+class ExportManifest:
+    """
+    Content hash and output partition of every exported track, used to only export new or changed tracks
+    """
+    path: str
+    entries: Dict[str, dict]
 
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as infile:
+                self.entries = json.load(infile)
 
-def pitches_to_dataframe(p):
-    return pd.DataFrame(p).sort_values(by=["timestamp"])
+    @staticmethod
+    def content_hash(doc: dict) -> str:
+        return hashlib.sha1(bson.encode(doc)).hexdigest()
 
+    def is_current(self, track_id: str, content_hash: str) -> bool:
+        entry = self.entries.get(track_id)
+        return entry is not None and entry["hash"] == content_hash
 
-def max_of_pitches(freq: List[Dict[str, float]], pitch: chr):
-    return max([item[pitch] for item in freq])
+    def record(self, track_id: str, content_hash: str, partition: str) -> Optional[str]:
+        """
+        :return: the partition holding the previous export of the track
+        """
+        previous = self.entries.get(track_id)
+        self.entries[track_id] = {"hash": content_hash, "partition": partition}
+        return previous["partition"] if previous is not None else None
 
+    def remove(self, track_id: str) -> Optional[str]:
+        previous = self.entries.pop(track_id, None)
+        return previous["partition"] if previous is not None else None
 
-def min_of_pitches(freq: List[Dict[str, float]], pitch: chr):
-    return min([item[pitch] for item in freq])
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as outfile:
+            json.dump(self.entries, outfile)
+        os.replace(temporary_path, self.path)
 
 
-if __name__ == "__main__":
-    for tracks in tracks(track_collection):
-        df = pd.DataFrame(tracks)
+def tracks(collection: Collection, limit=400, after_id: Optional[Any] = None, retries=5):
+    """
+    Stream the tracks of a collection in batches over a single cursor sorted by _id.
+    If the cursor fails it is reopened after the last yielded track.
+    :param limit: tracks per batch
+    :param after_id: only stream tracks with a greater _id, e.g. the last id of an export checkpoint
+    :param retries: consecutive failures before the error is raised
+    """
+    last_id = after_id
+    failures = 0
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        print("fetching tracks after", last_id)
         try:
-            df.set_index("_id", inplace=True)
-        except KeyError:
-            print("Done")
+            docs = collection.find(query, exported_fields, allow_disk_use=True, batch_size=limit)\
+                .sort("_id", ASCENDING)
+            current_track_data = []
+            for doc in docs:
+                current_track_data.append(doc)
+                if len(current_track_data) == limit:
+                    yield current_track_data
+                    last_id = current_track_data[-1]["_id"]
+                    current_track_data = []
+                    failures = 0
+            if len(current_track_data) > 0:
+                yield current_track_data
+            return
+        except PyMongoError as e:
+            failures += 1
+            if failures > retries:
+                raise
+            print("Error while fetching tracks, resuming after", last_id, ":", e)
+            sleep(failures)
+
+
+def duplicated_tracks(collection: Collection, track_ids: List[str]) -> Dict[str, Any]:
+    """
+    Tracks of track_ids that were crawled more than once, re-crawls used to insert instead of upsert
+    :return: spotify id -> _id of the newest document of every duplicated track
+    """
+    if len(track_ids) == 0:
+        return {}
+    duplicates = collection.aggregate([
+        {"$match": {"id": {"$in": track_ids}}},
+        {"$group": {"_id": "$id", "count": {"$sum": 1}, "newest": {"$max": "$_id"}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    return {doc["_id"]: doc["newest"] for doc in duplicates}
+
+
+def pitch_feature_columns() -> List[str]:
+    extrema = [f"{sym}_{extremum}" for sym in pitch_symbol for extremum in ("max", "min")]
+    return extrema + [f"{sym}_{step}" for sym in pitch_symbol for step in range(resampled_steps)]
+
+
+def pitch_features(pitches: List[dict]) -> np.ndarray:
+    """
+    Pitch features of a batch of tracks: maximum and minimum of every pitch class followed by
+    the resampled pitch classes, in the order of pitch_feature_columns
+    """
+    return packed_pitch_features(*pack_pitches(pitches))
+
+
+def pack_pitches(pitches: List[dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Concatenate the decoded pitches of a batch, the segments of track i are starts[offsets[i]:offsets[i + 1]]
+    :return: segment start times, pitch matrix and offsets of every track
+    """
+    decoded = [decode_pitches(p) for p in pitches]
+    offsets = np.cumsum([0] + [len(starts) for starts, _ in decoded])
+    if len(decoded) == 0:
+        return np.empty(0), np.empty((0, PITCH_CLASSES), dtype=np.float32), offsets
+    starts = np.concatenate([starts for starts, _ in decoded])
+    values = np.concatenate([values for _, values in decoded])
+    return starts, values, offsets
+
+
+def packed_pitch_features(starts: np.ndarray, values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    extrema_width = 2 * PITCH_CLASSES
+    features = np.full((len(offsets) - 1, extrema_width + PITCH_CLASSES * resampled_steps), np.nan, dtype=np.float64)
+    for row in range(len(offsets) - 1):
+        track_starts = starts[offsets[row]:offsets[row + 1]]
+        track_values = values[offsets[row]:offsets[row + 1]]
+        if len(track_starts) == 0:
             continue
-        df = df[~df["pitches"].isna()]
-        tags = pd.Series(flatmap(df[~df["tags"].isna()]["tags"].values.tolist())).apply(tolower).drop_duplicates()
-        pitches = df["pitches"].apply(pitch_trans)
-        df["pitches"] = pitches
-        for sym in pitch_symbol:
-            df.insert(len(df.columns), f"{sym}_max", [max_of_pitches(item, sym) for item in df["pitches"]])
-            df.insert(len(df.columns), f"{sym}_min", [min_of_pitches(item, sym) for item in df["pitches"]])
-        temp_df = pd.DataFrame()
-
-        for index, row in enumerate(df["pitches"].values):
-            song = pitches_to_dataframe(row)
-            song["timestamp"] = song["timestamp"].apply(pd.to_timedelta, unit='s')
-            resampled: pd.DataFrame = song.set_index("timestamp").resample(
-                f"{song.iloc[-1]['timestamp'].total_seconds() * 10 // 1}ms").mean().interpolate()[:100]
-            d: pd.DataFrame = pd.DataFrame()
-            for col in resampled.columns:
-                if col == "timestamp":
-                    continue
-                d = pd.concat([d, pd.DataFrame({f"{col}_{row_idx}": [val] for row_idx, val in enumerate(resampled[col].values)},
-                                               index=[df.index[index]])], axis=1)
-            temp_df = pd.concat([temp_df, d])
-
-        df = pd.concat([df, temp_df], axis=1)
-        df.drop(columns=["pitches"], inplace=True)  # drop unprocessed pitches
-        with open("songs.csv", 'a') as f:
-            df.to_csv(f, mode='a', header=f.tell() == 0, index=False)
+        features[row, 0:extrema_width:2] = track_values.max(axis=0)
+        features[row, 1:extrema_width:2] = track_values.min(axis=0)
+        features[row, extrema_width:] = resample(track_starts, track_values, resampled_steps).ravel()
+    return features
+
+
+def prepare_batch(tracks: List[dict], resolver: Optional[TagResolver] = None) -> Optional[pd.DataFrame]:
+    """
+    :param resolver: resolves the raw tags of the tracks collection, tracks without tags are dropped
+    :return: the tracks with pitches as a dataframe indexed by _id, None if the batch is empty
+    """
+    df = pd.DataFrame(tracks)
+    try:
+        df.set_index("_id", inplace=True)
+    except KeyError:
+        return None
+    df = df[[field for field in exported_fields if field in df.columns]]
+    df = df[~df["pitches"].isna()]
+    if resolver is not None and "tags" in df.columns:
+        df["tags"] = resolver.resolve_names_many(df["tags"].tolist())
+        df = df[df["tags"].str.len() > 0]
+    return df
+
+
+def finish_batch(df: pd.DataFrame, features: np.ndarray) -> pd.DataFrame:
+    features = pd.DataFrame(features, columns=pitch_feature_columns(), index=df.index)
+    df = pd.concat([df.drop(columns=["pitches"]), features], axis=1)
+    if "id" in df.columns:
+        df = df.set_index("id")  # spotify id of the raw tracks collection
+    return df
+
+
+def export(collection: Collection, writer, workers: int = 1, checkpoint: Optional[ExportCheckpoint] = None,
+           manifest: Optional[ExportManifest] = None, resolver: Optional[TagResolver] = None):
+    """
+    Export all tracks of a collection. With more than one worker the pitch features of the batches are computed
+    in a process pool, the batches are still written in the order they were fetched.
+    :param writer: CsvSongWriter or ParquetSongWriter
+    :param workers: number of processes computing pitch features
+    :param checkpoint: the last written _id is stored after every batch, the export resumes from it
+    :param manifest: only export tracks that are new or changed since the last export,
+                     stale rows are removed from their partitions (ParquetSongWriter only)
+    :param resolver: resolves raw tags to the allowed tags, needed when exporting the raw tracks collection
+    """
+    after_id = checkpoint.load() if checkpoint is not None else None
+    hashes = {}
+    stale = {}
+    seen = set()
+    duplicated = set()
+
+    def newest(batch: List[dict]) -> List[dict]:
+        duplicates = duplicated_tracks(collection, list({doc["id"] for doc in batch if "id" in doc}))
+        duplicated.update(duplicates)
+        return [doc for doc in batch if duplicates.get(doc.get("id"), doc["_id"]) == doc["_id"]]
+
+    def changed(batch: List[dict]) -> List[dict]:
+        changed_tracks = []
+        for doc in batch:
+            track_id = str(doc.get("id", doc["_id"]))
+            seen.add(track_id)
+            content_hash = ExportManifest.content_hash(doc)
+            if not manifest.is_current(track_id, content_hash):
+                hashes[track_id] = content_hash
+                changed_tracks.append(doc)
+        return changed_tracks
+
+    def write(df: pd.DataFrame, features: np.ndarray):
+        finished = finish_batch(df, features)
+        partition = writer.write(finished)
+        if manifest is not None:
+            for track_id in finished.index.astype(str):
+                previous = manifest.record(track_id, hashes.pop(track_id), partition)
+                if previous is not None:
+                    stale.setdefault(previous, set()).add(track_id)
+        if checkpoint is not None:
+            checkpoint.save(df.index[-1])
+
+    batches = map(newest, tracks(collection, after_id=after_id))
+    if manifest is not None:
+        batches = map(changed, batches)
+    batches = (prepare_batch(batch, resolver) for batch in batches)
+    batches = (df for df in batches if df is not None and len(df) > 0)
+    try:
+        if workers <= 1:
+            for df in batches:
+                write(df, pitch_features(df["pitches"].tolist()))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for df in batches:
+                    pitches = pack_pitches(df["pitches"].tolist())
+                    pending.append((df, executor.submit(packed_pitch_features, *pitches)))
+                    while len(pending) > 2 * workers:
+                        df, features = pending.popleft()
+                        write(df, features.result())
+                while len(pending) > 0:
+                    df, features = pending.popleft()
+                    write(df, features.result())
+    finally:
+        writer.close()
+    if len(duplicated) > 0:
+        print("kept the newest document of", len(duplicated), "duplicated tracks")
+
+    if manifest is not None:
+        dropped = set(hashes)  # changed tracks that are no longer exported, e.g. because they lost their tags
+        if after_id is None:
+            dropped |= set(manifest.entries) - seen
+        for track_id in dropped & set(manifest.entries):
+            stale.setdefault(manifest.remove(track_id), set()).add(track_id)
+        for partition, track_ids in stale.items():
+            print("compacting", partition, "removing", len(track_ids), "stale tracks")
+            writer.remove_rows(partition, track_ids)
+        manifest.save()
+    if checkpoint is not None:
+        checkpoint.clear()
+    print("Done")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the preprocessed tracks with their pitch features")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--output", help="csv file or parquet directory, songs.csv / songs.parquet by default")
+    parser.add_argument("--collection", default="tracks",
+                        help="tracks are exported with locally resolved tags, "
+                             "preprocessed_tracks is the view already normalised by mongo_aggregation")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only export new or changed tracks into the parquet output")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes computing pitch features")
+    args = parser.parse_args()
+    if args.format == "parquet":
+        writer = ParquetSongWriter(args.output or "songs.parquet", float32_columns=pitch_feature_columns())
+    else:
+        writer = CsvSongWriter(args.output or "songs.csv")
+
+    manifest = None
+    if args.incremental:
+        if args.format != "parquet":
+            parser.error("--incremental requires --format parquet")
+        manifest = ExportManifest(os.path.join(writer.path, "_manifest.json"))
+
+    resolver = TagResolver.from_collection(db["allowed_tags"]) if args.collection == "tracks" else None
+    export(db[args.collection], writer, workers=args.workers, checkpoint=ExportCheckpoint(), manifest=manifest,
+           resolver=resolver)
@@ -0,0 +1,243 @@
+"""
+Local stand-in for the spotify web api and the last.fm tag pages, so crawlers can be run and load tested
+without credentials. Every playlist holds playlist_size tracks, all responses are derived from the ids,
+so repeated runs see the same data.
+
+    python fake_spotify.py --port 5100
+    python distributed.py worker --fake http://127.0.0.1:5100
+"""
+
+import argparse
+import random
+from dataclasses import replace
+from time import sleep
+from typing import Optional
+
+import httpx
+import requests
+import tekore as tk
+from flask import Flask, request, jsonify
+
+SPOTIFY_API = "https://api.spotify.com"
+LASTFM_WEBSITE = "https://www.last.fm"
+ARTISTS = 500
+GENRES = ["rock", "pop", "jazz", "techno", "hip hop", "folk", "metal", "classical", "soul", "punk"]
+
+
+def fake_id(prefix: str, number: int) -> str:
+    return f"{prefix}{number:0{22 - len(prefix)}d}"
+
+
+def id_number(spotify_id: str) -> int:
+    digits = "".join(c for c in spotify_id if c.isdigit())
+    return int(digits) if digits != "" else sum(map(ord, spotify_id))
+
+
+def _item(kind: str, spotify_id: str) -> dict:
+    return {"id": spotify_id,
+            "href": f"{SPOTIFY_API}/v1/{kind}s/{spotify_id}",
+            "type": kind,
+            "uri": f"spotify:{kind}:{spotify_id}",
+            "external_urls": {}}
+
+
+def simple_artist(number: int) -> dict:
+    return {**_item("artist", fake_id("ar", number)), "name": f"Artist {number}"}
+
+
+def full_artist(artist_id: str) -> dict:
+    number = id_number(artist_id)
+    return {**simple_artist(number),
+            "followers": {"href": None, "total": number},
+            "genres": [GENRES[number % len(GENRES)], GENRES[(number // len(GENRES)) % len(GENRES)]],
+            "images": [],
+            "popularity": number % 100}
+
+
+def full_track(track_id: str) -> dict:
+    number = id_number(track_id)
+    artists = [simple_artist(number % ARTISTS)] + ([simple_artist((number * 7) % ARTISTS)] if number % 3 == 0 else [])
+    return {**_item("track", track_id),
+            "name": f"Track {number}",
+            "artists": artists,
+            "album": {**_item("album", fake_id("al", number)),
+                      "album_type": "album",
+                      "artists": artists,
+                      "images": [],
+                      "name": f"Album {number}",
+                      "total_tracks": 10,
+                      "release_date": "2020-01-01",
+                      "release_date_precision": "day"},
+            "disc_number": 1,
+            "duration_ms": 120_000 + (number % 240) * 1000,
+            "explicit": False,
+            "external_ids": {},
+            "is_local": False,
+            "popularity": number % 100,
+            "preview_url": None,
+            "track_number": 1}
+
+
+def playlist_track(track_id: str) -> dict:
+    return {"added_at": "2020-01-01T00:00:00Z",
+            "added_by": _item("user", "fake"),
+            "is_local": False,
+            "primary_color": None,
+            "video_thumbnail": None,
+            "track": {**full_track(track_id), "episode": False, "track": True}}
+
+
+def audio_features(track_id: str) -> dict:
+    generator = random.Random(track_id)
+    return {"id": track_id,
+            "type": "audio_features",
+            "uri": f"spotify:track:{track_id}",
+            "track_href": f"{SPOTIFY_API}/v1/tracks/{track_id}",
+            "analysis_url": f"{SPOTIFY_API}/v1/audio-analysis/{track_id}",
+            "duration_ms": full_track(track_id)["duration_ms"],
+            "acousticness": generator.random(),
+            "danceability": generator.random(),
+            "energy": generator.random(),
+            "instrumentalness": generator.random(),
+            "key": generator.randrange(12),
+            "liveness": generator.random(),
+            "loudness": -generator.uniform(0, 30),
+            "mode": generator.randrange(2),
+            "speechiness": generator.random(),
+            "tempo": generator.uniform(60, 180),
+            "time_signature": 4,
+            "valence": generator.random()}
+
+
+def audio_analysis(track_id: str, segments: int = 400) -> dict:
+    generator = random.Random(track_id)
+    duration = full_track(track_id)["duration_ms"] / 1000
+    step = duration / segments
+    return {"bars": [], "beats": [], "sections": [], "tatums": [],
+            "meta": {}, "track": {"duration": duration},
+            "segments": [{"start": i * step,
+                          "duration": step,
+                          "confidence": 1.0,
+                          "loudness_start": -20.0,
+                          "loudness_max": -10.0,
+                          "loudness_max_time": 0.0,
+                          "loudness_end": -20.0,
+                          "pitches": [generator.random() for _ in range(12)],
+                          "timbre": [0.0] * 12} for i in range(segments)]}
+
+
+def tag_page(artist: str) -> str:
+    number = id_number(artist)
+    tags = [GENRES[number % len(GENRES)], "seen live"]
+    return "<html><body>" + "".join(f'<a href="/tag/{tag}">{tag}</a>' for tag in tags) + "</body></html>"
+
+
+def create_app(playlist_size: int = 1000, latency: float = 0, error_rate: float = 0) -> Flask:
+    """
+    :param playlist_size: number of tracks of every playlist
+    :param latency: seconds every response is delayed
+    :param error_rate: share of requests answered with 429 or 503
+    """
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False  # tekore requests some collections with a trailing slash
+
+    @app.before_request
+    def simulate_network():
+        if latency > 0:
+            sleep(latency)
+        if error_rate > 0 and random.random() < error_rate:
+            if random.random() < 0.5:
+                return jsonify({"error": {"status": 429, "message": "rate limited"}}), 429, {"Retry-After": "1"}
+            return jsonify({"error": {"status": 503, "message": "unavailable"}}), 503
+
+    @app.route("/v1/playlists/<playlist_id>/tracks")
+    def playlist_items(playlist_id: str):
+        offset = request.args.get("offset", 0, type=int)
+        limit = request.args.get("limit", 100, type=int)
+        first = id_number(playlist_id) * playlist_size
+        items = [playlist_track(fake_id("tr", first + i)) for i in range(offset, min(offset + limit, playlist_size))]
+        return jsonify({"href": request.url, "items": items, "limit": limit, "next": None,
+                        "offset": offset, "previous": None, "total": playlist_size})
+
+    @app.route("/v1/tracks")
+    def tracks():
+        return jsonify({"tracks": [full_track(track_id) for track_id in request.args["ids"].split(",")]})
+
+    @app.route("/v1/artists")
+    def artists():
+        return jsonify({"artists": [full_artist(artist_id) for artist_id in request.args["ids"].split(",")]})
+
+    @app.route("/v1/audio-features")
+    def features():
+        return jsonify({"audio_features": [audio_features(track_id) for track_id in request.args["ids"].split(",")]})
+
+    @app.route("/v1/audio-analysis/<track_id>")
+    def analysis(track_id: str):
+        return jsonify(audio_analysis(track_id))
+
+    @app.route("/v1/search")
+    def search():
+        offset = request.args.get("offset", 0, type=int)
+        limit = request.args.get("limit", 20, type=int)
+        first = sum(map(ord, request.args.get("q", ""))) * 10_000 + offset
+        items = [full_track(fake_id("tr", first + i)) for i in range(limit)]
+        return jsonify({"tracks": {"href": request.url, "items": items, "limit": limit, "next": None,
+                                   "offset": offset, "previous": None, "total": 10_000}})
+
+    @app.route("/music/<artist>/_/<track>/+tags")
+    def tags(artist: str, track: str):
+        return tag_page(artist)
+
+    return app
+
+
+class RedirectSender(tk.SyncSender):
+    """
+    Sends the requests of a tekore client to base_url instead of api.spotify.com
+    """
+    base_url: str
+
+    def __init__(self, base_url: str, client=None):
+        super().__init__(client)
+        self.base_url = base_url.rstrip("/")
+
+    def send(self, request: tk.Request) -> tk.Response:
+        return super().send(replace(request, url=request.url.replace(SPOTIFY_API, self.base_url, 1)))
+
+
+class RedirectSession(requests.Session):
+    """
+    Session that sends the requests of the last.fm scraper to base_url instead of www.last.fm
+    """
+    base_url: str
+
+    def __init__(self, base_url: str):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, url.replace(LASTFM_WEBSITE, self.base_url, 1), *args, **kwargs)
+
+
+def fake_token() -> tk.Token:
+    return tk.Token({"access_token": "fake", "token_type": "Bearer", "expires_in": 10 ** 9,
+                     "refresh_token": None, "scope": ""}, uses_pkce=False)
+
+
+def fake_spotify(base_url: str, max_connections: Optional[int] = None) -> tk.Spotify:
+    """
+    :return: synchronous tekore client talking to the fake server at base_url
+    """
+    client = httpx.Client(limits=httpx.Limits(max_connections=max_connections)) if max_connections else None
+    return tk.Spotify(fake_token(), sender=RedirectSender(base_url, client))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake spotify api and last.fm tag pages")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--playlist-size", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+    create_app(args.playlist_size, args.latency, args.error_rate).run(args.host, args.port, threaded=True)
@@ -1,54 +1,255 @@
+import asyncio
 import logging
+import re
+import threading
 import urllib.parse
-from typing import Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import Set, List, Tuple, Optional
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from pylast import LastFMNetwork
 
+from lastfm.cache import TagCache
+from project.metrics import METRICS
+from project.rate_limit import HostLimiter, CircuitOpenError, limiter_for
+
+logger = logging.getLogger(__name__)
+
+
+TAG_LINKS = SoupStrainer("a", href=re.compile("^/tag/"))
+
+
+def tags_url(artist: str, track: str) -> str:
+    artist = urllib.parse.quote(artist)
+    track = urllib.parse.quote(track)
+    return f"https://www.last.fm/music/{artist}/_/{track}/+tags"
+
+
+def parse_tags(content: bytes, parser: str = "html.parser") -> Set[str]:
+    with METRICS.span("parse_tags"):
+        tags_html = BeautifulSoup(content, features=parser, parse_only=TAG_LINKS)
+        tag_links = tags_html.find_all("a", href=True)
+        return {t.text for t in tag_links if t.text != ""}
+
+
+def _count_response(status_code: int, size: int):
+    METRICS.increment("api_requests", host="www.last.fm", status=status_code)
+    METRICS.increment("bytes_received", size, host="www.last.fm")
+
 
 class LastFmScraper:
-    def __init__(self):
-        pass
+    """
+    Scrapes the tags of a track from the last.fm website.
+    Requests share a keep-alive session and the rate limit of www.last.fm, only the tag links of a page are parsed.
+    """
+    session: requests.Session
+    parser: str
+    max_workers: int
+    limiter: HostLimiter
+
+    def __init__(self, parser: str = "html.parser", max_workers: int = 8,
+                 session: Optional[requests.Session] = None):
+        """
+        :param parser: BeautifulSoup parser, e.g. "lxml" if it is installed
+        :param max_workers: maximum number of concurrent requests to last.fm
+        :param session: session to reuse with its own transport adapters, a new pooled one is created otherwise
+        """
+        self.parser = parser
+        self.max_workers = max_workers
+        self.limiter = limiter_for("www.last.fm")
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.session = session
+        self._politeness = threading.Semaphore(max_workers)
 
     def get_tags(self, artist: str, track: str) -> Set[str]:
-        artist = urllib.parse.quote(artist)
-        track = urllib.parse.quote(track)
-        url = f"https://www.last.fm/music/{artist}/_/{track}/+tags"
-        r = requests.get(url)
-        tags_html = BeautifulSoup(r.content, features="html.parser")
-        tag_links = tags_html.find_all("a", href=True)
-        return {t.text for t in tag_links if t["href"].startswith("/tag/") and t.text != ""}
+        with self._politeness:
+            r = self.limiter.call(self._get, tags_url(artist, track))
+        return parse_tags(r.content, self.parser)
+
+    def get_tags_many(self, pairs: List[Tuple[str, str]]) -> List[Optional[Set[str]]]:
+        """
+        Scrape the tags of many tracks concurrently
+        :param pairs: (artist, track) pairs
+        :return: tags in the order of the pairs, None if a request failed
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self._get_tags_or_none, pairs))
+
+    def _get_tags_or_none(self, pair: Tuple[str, str]) -> Optional[Set[str]]:
+        artist, track = pair
+        try:
+            return self.get_tags(artist, track)
+        except (requests.RequestException, CircuitOpenError) as e:
+            logger.warning(f"Could not scrape tags of '{track}' from {artist}: {e}")
+            return None
+
+    def _get(self, url: str) -> requests.Response:
+        r = self.session.get(url)
+        _count_response(r.status_code, len(r.content))
+        if r.status_code == 429 or r.status_code >= 500:
+            r.raise_for_status()  # let the limiter back off, a 404 just means last.fm does not know the track
+        return r
+
+
+class AsyncLastFmScraper:
+    """
+    Asynchronous version of LastFmScraper on top of a httpx.AsyncClient
+    """
+    client: httpx.AsyncClient
+    parser: str
+    limiter: HostLimiter
+
+    def __init__(self, parser: str = "html.parser", max_connections: int = 16,
+                 client: Optional[httpx.AsyncClient] = None):
+        self.parser = parser
+        self.limiter = limiter_for("www.last.fm")
+        self.client = client if client is not None else httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections), follow_redirects=True)
+
+    async def get_tags(self, artist: str, track: str) -> Set[str]:
+        r = await self.limiter.call_async(self._get, tags_url(artist, track))
+        return parse_tags(r.content, self.parser)
+
+    async def get_tags_many(self, pairs: List[Tuple[str, str]]) -> List[Optional[Set[str]]]:
+        """
+        :return: tags in the order of the pairs, None if a request failed
+        """
+        return list(await asyncio.gather(*(self._get_tags_or_none(artist, track) for artist, track in pairs)))
+
+    async def _get_tags_or_none(self, artist: str, track: str) -> Optional[Set[str]]:
+        try:
+            return await self.get_tags(artist, track)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.warning(f"Could not scrape tags of '{track}' from {artist}: {e}")
+            return None
+
+    async def _get(self, url: str) -> httpx.Response:
+        r = await self.client.get(url)
+        _count_response(r.status_code, len(r.content))
+        if r.status_code == 429 or r.status_code >= 500:
+            r.raise_for_status()
+        return r
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def put_fetched_tags(cache: TagCache, pairs: List[Tuple[str, str]], tags: List[Optional[Set[str]]]):
+    """
+    Cache the tags of the lookups that got an answer, an outage must not be cached as "no tags"
+    """
+    answered = [(pair, pair_tags) for pair, pair_tags in zip(pairs, tags) if pair_tags is not None]
+    if len(answered) > 0:
+        cache.put_many([pair for pair, _ in answered], [pair_tags for _, pair_tags in answered])
+
+
+def cached_tags(cache: TagCache,
+                pairs: List[Tuple[str, str]]) -> Tuple[List[Optional[Set[str]]], List[Tuple[str, str]]]:
+    """
+    :return: cached tags in the order of the pairs, None if a pair is not cached, and the distinct missing pairs
+    """
+    tags = cache.get_many(pairs)
+    missing = {}
+    for pair, cached in zip(pairs, tags):
+        if cached is None:
+            missing.setdefault(TagCache.key(*pair), pair)
+    METRICS.increment("tag_cache_hits", len(pairs) - sum(cached is None for cached in tags))
+    METRICS.increment("tag_cache_misses", sum(cached is None for cached in tags))
+    return tags, list(missing.values())
+
+
+def merge_fetched_tags(cache: TagCache, pairs: List[Tuple[str, str]], cached: List[Optional[Set[str]]],
+                       missing: List[Tuple[str, str]], fetched_tags: List[Optional[Set[str]]]) -> List[Set[str]]:
+    """
+    Cache the tags fetched for the missing pairs of cached_tags and fill them in
+    :return: tags in the order of the pairs, an empty set if the lookup failed
+    """
+    put_fetched_tags(cache, missing, fetched_tags)
+    fetched = {TagCache.key(*pair): pair_tags for pair, pair_tags in zip(missing, fetched_tags)}
+    return [pair_tags if pair_tags is not None else fetched[TagCache.key(*pair)] or set()
+            for pair, pair_tags in zip(pairs, cached)]
 
 
 class LastFmProxy:
     network: LastFMNetwork
     scraper: LastFmScraper
     scraper_only: bool
+    cache: Optional[TagCache]
 
-    def __init__(self, network: LastFMNetwork, scraper: LastFmScraper, scraper_only: bool = False):
+    def __init__(self, network: LastFMNetwork, scraper: LastFmScraper, scraper_only: bool = False,
+                 cache: Optional[TagCache] = None):
         self.network = network
         self.scraper = scraper
         self.scraper_only = scraper_only
+        self.cache = cache
 
     def get_tags(self, artist: str, track: str) -> Set[str]:
+        if self.cache is not None:
+            cached = self.cache.get(artist, track)
+            if cached is not None:
+                METRICS.increment("tag_cache_hits")
+                return cached
+            METRICS.increment("tag_cache_misses")
+        tags = self._fetch_tags(artist, track)
+        if self.cache is not None:
+            self.cache.put(artist, track, tags)
+        return tags
+
+    def get_tags_many(self, pairs: List[Tuple[str, str]]) -> List[Set[str]]:
+        """
+        :return: tags in the order of the pairs, an empty set if the lookup failed. Failed lookups are not cached.
+        """
+        if self.cache is None:
+            return [tags if tags is not None else set() for tags in self._fetch_tags_many(pairs)]
+        tags, missing = cached_tags(self.cache, pairs)
+        if len(missing) == 0:
+            return tags
+        return merge_fetched_tags(self.cache, pairs, tags, missing, self._fetch_tags_many(missing))
+
+    def _fetch_tags(self, artist: str, track: str) -> Set[str]:
         scrapped_tags = self.scraper.get_tags(artist, track)
         if self.scraper_only:
             return scrapped_tags
         try:
             tags = self._get_tags_with_network(artist, track)
         except:
-            logging.debug(f"Track '{track}' from {artist} not found")
+            logger.debug(f"Track '{track}' from {artist} not found")
             tags = set()
         return tags.union(scrapped_tags)
 
+    def _fetch_tags_many(self, pairs: List[Tuple[str, str]]) -> List[Optional[Set[str]]]:
+        """
+        :return: tags in the order of the pairs, None if the page of the track could not be scraped
+        """
+        scrapped_tags = self.scraper.get_tags_many(pairs)
+        if self.scraper_only:
+            return scrapped_tags
+        tags = []
+        for (artist, track), scrapped in zip(pairs, scrapped_tags):
+            if scrapped is None:
+                tags.append(None)
+                continue
+            try:
+                network_tags = self._get_tags_with_network(artist, track)
+            except:
+                logger.debug(f"Track '{track}' from {artist} not found")
+                network_tags = set()
+            tags.append(network_tags.union(scrapped))
+        return tags
+
     def _get_tags_with_network(self, artist: str, track: str) -> Set[str]:
-        return {tag.item.name for tag in self.network.get_track(artist, track).get_top_tags()}
+        top_tags = limiter_for("ws.audioscrobbler.com").call(self.network.get_track(artist, track).get_top_tags)
+        return {tag.item.name for tag in top_tags}
 
     def __getattr__(self, attr):
         dispatcher = getattr(self.network, attr)
         if dispatcher is None:
-            logging.warning(f"{attr} does not exist on LastFMNetwork")
+            logger.warning(f"{attr} does not exist on LastFMNetwork")
             return
         return dispatcher
 
@@ -0,0 +1,110 @@
+import json
+import sqlite3
+import threading
+from time import time
+from typing import Set, List, Tuple, Optional
+
+DAY = 24 * 60 * 60
+
+
+class TagCache:
+    """
+    Persistent cache of last.fm tags keyed on the normalised (artist, track) pair.
+    Empty results are cached as well but expire sooner, the least recently used entries are evicted
+    once the cache holds more than max_entries.
+    """
+    path: str
+    positive_ttl: float
+    negative_ttl: float
+    max_entries: int
+    hits: int
+    misses: int
+
+    def __init__(self, path: str = ".lastfm_tags.sqlite",
+                 positive_ttl: float = 30 * DAY,
+                 negative_ttl: float = DAY,
+                 max_entries: int = 500_000):
+        self.path = path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tags ("
+                                     "key TEXT PRIMARY KEY, "
+                                     "tags TEXT NOT NULL, "
+                                     "stored_at REAL NOT NULL, "
+                                     "accessed_at REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS tags_accessed_at ON tags (accessed_at)")
+
+    @staticmethod
+    def key(artist: str, track: str) -> str:
+        return " ".join(artist.casefold().split()) + "\x1f" + " ".join(track.casefold().split())
+
+    def get(self, artist: str, track: str) -> Optional[Set[str]]:
+        """
+        :return: the cached tags, an empty set for a cached negative result or None if the pair is not cached
+        """
+        return self.get_many([(artist, track)])[0]
+
+    def get_many(self, pairs: List[Tuple[str, str]]) -> List[Optional[Set[str]]]:
+        keys = [TagCache.key(artist, track) for artist, track in pairs]
+        now = time()
+        with self._lock:
+            rows = {}
+            for i in range(0, len(keys), 500):
+                chunk = list(set(keys[i:i + 500]))
+                placeholders = ",".join("?" * len(chunk))
+                for key, tags, stored_at in self._connection.execute(
+                        f"SELECT key, tags, stored_at FROM tags WHERE key IN ({placeholders})", chunk):
+                    rows[key] = (json.loads(tags), stored_at)
+
+            results = []
+            for key in keys:
+                row = rows.get(key)
+                if row is None or self._expired(row[0], row[1], now):
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append(set(row[0]))
+
+            fresh = [(now, key) for key, row in rows.items() if not self._expired(row[0], row[1], now)]
+            with self._connection:
+                self._connection.executemany("UPDATE tags SET accessed_at = ? WHERE key = ?", fresh)
+        return results
+
+    def put(self, artist: str, track: str, tags: Set[str]):
+        self.put_many([(artist, track)], [tags])
+
+    def put_many(self, pairs: List[Tuple[str, str]], tags: List[Set[str]]):
+        now = time()
+        rows = [(TagCache.key(artist, track), json.dumps(sorted(track_tags)), now, now)
+                for (artist, track), track_tags in zip(pairs, tags)]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+
+    def _expired(self, tags: list, stored_at: float, now: float) -> bool:
+        ttl = self.positive_ttl if len(tags) > 0 else self.negative_ttl
+        return now - stored_at > ttl
+
+    def _evict(self):
+        size = self._connection.execute("SELECT COUNT(*) FROM tags").fetchone()[0]
+        if size > self.max_entries:
+            self._connection.execute("DELETE FROM tags WHERE key IN "
+                                     "(SELECT key FROM tags ORDER BY accessed_at LIMIT ?)",
+                                     (size - self.max_entries,))
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM tags").fetchone()[0]
+
+    def __repr__(self):
+        return f"TagCache(path={self.path}, hits={self.hits}, misses={self.misses})"
@@ -0,0 +1,257 @@
+"""
+Instrumentation of a crawl: timing spans, counters and logging.
+
+    with METRICS.span("retrieve_tags"):
+        ...
+    METRICS.increment("bytes_received", len(content), host="www.last.fm")
+    METRICS.dump("metrics.prom")  # Prometheus text format, metrics.json for json
+
+The counters of the host limiters (calls, retries, rate limited responses, failures) are part of every dump.
+"""
+import inspect
+import json
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter, time
+from typing import Coroutine, Dict, Optional, Tuple, Union
+
+import httpx
+import numpy as np
+import tekore as tk
+
+from project.rate_limit import limiter_metrics
+
+PREFIX = "mcml"
+QUANTILES = [0.5, 0.9, 0.99]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class SpanStats:
+    """
+    Count and total duration of a span, quantiles are taken over the last window durations
+    """
+    count: int
+    errors: int
+    total: float
+
+    def __init__(self, window: int = 10000):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self._durations = deque(maxlen=window)
+
+    def add(self, duration: float, failed: bool = False):
+        self.count += 1
+        self.errors += failed
+        self.total += duration
+        self._durations.append(duration)
+
+    def quantiles(self) -> Dict[float, float]:
+        if len(self._durations) == 0:
+            return {quantile: 0.0 for quantile in QUANTILES}
+        return dict(zip(QUANTILES, np.quantile(np.array(self._durations), QUANTILES).tolist()))
+
+    def to_dict(self) -> dict:
+        return {"count": self.count,
+                "errors": self.errors,
+                "total_seconds": round(self.total, 6),
+                **{f"p{round(quantile * 100)}_seconds": round(value, 6)
+                   for quantile, value in self.quantiles().items()}}
+
+
+class Metrics:
+    """
+    Thread safe registry of counters and spans
+    """
+    _counters: Dict[Tuple[str, Labels], float]
+    _spans: Dict[str, SpanStats]
+
+    def __init__(self):
+        self._counters = {}
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name: str, **labels) -> float:
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        Time the body of the with statement, failed bodies are counted as errors of the span
+        """
+        start = perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record(name, perf_counter() - start, failed)
+
+    def record(self, name: str, duration: float, failed: bool = False):
+        with self._lock:
+            if name not in self._spans:
+                self._spans[name] = SpanStats()
+            self._spans[name].add(duration, failed)
+
+    def timed(self, name: Optional[str] = None):
+        """
+        Decorator that runs every call of the function in a span, named after the function by default.
+        Coroutine functions are timed until they return.
+        """
+
+        def decorator(func):
+            span_name = name if name is not None else func.__name__.strip("_")
+
+            if inspect.iscoroutinefunction(func):
+                @wraps(func)
+                async def wrap_async(*args, **kwargs):
+                    with self.span(span_name):
+                        return await func(*args, **kwargs)
+
+                return wrap_async
+
+            @wraps(func)
+            def wrap(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+
+            return wrap
+
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._spans.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            counters = {}
+            for (name, labels), value in self._counters.items():
+                counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            spans = {name: stats.to_dict() for name, stats in self._spans.items()}
+        return {"timestamp": time(), "spans": spans, "counters": counters, "limiters": limiter_metrics()}
+
+    def to_prometheus(self) -> str:
+        snapshot = self.to_dict()
+        lines = []
+        for name, stats in snapshot["spans"].items():
+            metric = f"{PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for quantile in QUANTILES:
+                lines.append(f'{metric}{{quantile="{quantile}"}} {stats[f"p{round(quantile * 100)}_seconds"]}')
+            lines.append(f"{metric}_sum {stats['total_seconds']}")
+            lines.append(f"{metric}_count {stats['count']}")
+            lines.append(f"{PREFIX}_{name}_errors_total {stats['errors']}")
+        for name, values in snapshot["counters"].items():
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            for value in values:
+                lines.append(f"{PREFIX}_{name}_total{_labels(value['labels'])} {value['value']}")
+        for host, counters in snapshot["limiters"].items():
+            for name, value in counters.items():
+                suffix = "" if name.endswith("_seconds") else "_total"
+                lines.append(f"{PREFIX}_limiter_{name}{suffix}{_labels({'host': host})} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """
+        Write the metrics to path, as json if it ends with .json and in the Prometheus text format otherwise
+        """
+        with open(path, "w") as outfile:
+            if path.endswith(".json"):
+                json.dump(self.to_dict(), outfile, indent=2)
+            else:
+                outfile.write(self.to_prometheus())
+
+
+def _labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (label + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for label, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+METRICS = Metrics()
+
+
+class MeteredSender(tk.Sender):
+    """
+    Sender of a tekore client that counts the requests and the bytes received from spotify. tekore only hands
+    out parsed json, the bytes are counted by a response hook of the httpx client of the sender, senders without
+    one only count requests. Wrapping an asynchronous sender makes it asynchronous as well.
+    """
+    sender: tk.Sender
+    metrics: Metrics
+
+    def __init__(self, sender: Optional[tk.Sender] = None, metrics: Metrics = METRICS):
+        self.sender = sender if sender is not None else tk.SyncSender()
+        self.metrics = metrics
+        client = getattr(self.sender, "client", None)
+        if isinstance(client, (httpx.Client, httpx.AsyncClient)):
+            hook = self._count_bytes_async if isinstance(client, httpx.AsyncClient) else self._count_bytes
+            client.event_hooks = {**client.event_hooks, "response": client.event_hooks["response"] + [hook]}
+
+    @property
+    def is_async(self) -> bool:
+        return self.sender.is_async
+
+    def close(self):
+        return self.sender.close()
+
+    def send(self, request: tk.Request) -> Union[tk.Response, Coroutine[None, None, tk.Response]]:
+        if self.sender.is_async:
+            return self._send_async(request)
+        return self._record(self.sender.send(request))
+
+    async def _send_async(self, request: tk.Request) -> tk.Response:
+        return self._record(await self.sender.send(request))
+
+    def _record(self, response: tk.Response) -> tk.Response:
+        self.metrics.increment("api_requests", host="api.spotify.com", status=response.status_code)
+        return response
+
+    def _count_bytes(self, response: httpx.Response):
+        response.read()  # tekore reads the body right after the hook, it is not read twice
+        self.metrics.increment("bytes_received", response.num_bytes_downloaded, host="api.spotify.com")
+
+    async def _count_bytes_async(self, response: httpx.Response):
+        await response.aread()
+        self.metrics.increment("bytes_received", response.num_bytes_downloaded, host="api.spotify.com")
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per record, the extra fields of a record are included
+    """
+    RESERVED = set(vars(logging.makeLogRecord({})))
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": record.created, "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items()
+                      if key not in JsonFormatter.RESERVED and key != "message"})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: int = logging.INFO, structured: bool = False):
+    """
+    :param structured: log json lines instead of plain text
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if structured else
+                         logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
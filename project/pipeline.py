@@ -0,0 +1,157 @@
+import threading
+from queue import Queue, Empty, Full
+from time import perf_counter
+from typing import Callable, Iterable, List, Any, Optional
+
+_END = object()
+
+
+class StageStats:
+    name: str
+    items: int
+    busy: float
+    started: Optional[float]
+    finished: Optional[float]
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0
+        return (self.finished or perf_counter()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def utilisation(self) -> float:
+        return self.busy / self.elapsed if self.elapsed > 0 else 0
+
+    def __repr__(self):
+        return f"{self.name:<10} items={self.items:<6} busy={self.busy:8.2f}s " \
+               + f"throughput={self.throughput:6.2f}/s utilisation={self.utilisation:6.1%}"
+
+
+class Stage:
+    """
+    Step of a pipeline, the function is applied to every item that passes through the stage.
+    Returning None drops the item.
+    """
+    name: str
+    func: Callable[[Any], Any]
+
+    def __init__(self, name: str, func: Callable[[Any], Any]):
+        self.name = name
+        self.func = func
+
+
+class Pipeline:
+    """
+    Runs every stage in its own thread, stages are connected by bounded queues.
+    A full queue blocks the upstream stage (backpressure), so at most queue_size items wait between two stages.
+    """
+    stages: List[Stage]
+    queue_size: int
+    stats: List[StageStats]
+
+    def __init__(self, stages: List[Stage], queue_size: int = 2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = []
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+
+    def run(self, source: Iterable, source_name: str = "fetch") -> List[StageStats]:
+        self._stop.clear()
+        self._errors = []
+        self.stats = [StageStats(source_name)] + [StageStats(stage.name) for stage in self.stages]
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        threads = [threading.Thread(target=self._produce, args=(source, queues[0], self.stats[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._consume,
+                                            args=(stage, queues[i], outbox, self.stats[i + 1]),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        return self.stats
+
+    def report(self) -> str:
+        return "\n".join(repr(stats) for stats in self.stats)
+
+    def _produce(self, source: Iterable, outbox: Queue, stats: StageStats):
+        stats.started = perf_counter()
+        iterator = iter(source)
+        try:
+            while not self._stop.is_set():
+                start = perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats.busy += perf_counter() - start
+                stats.items += 1
+                self._put(outbox, item)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            stats.finished = perf_counter()
+            self._put(outbox, _END)
+
+    def _consume(self, stage: Stage, inbox: Queue, outbox: Optional[Queue], stats: StageStats):
+        stats.started = perf_counter()
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _END:
+                    break
+                if self._stop.is_set():
+                    continue  # drain the queue so upstream stages can finish
+                start = perf_counter()
+                result = stage.func(item)
+                stats.busy += perf_counter() - start
+                stats.items += 1
+                if outbox is not None and result is not None:
+                    self._put(outbox, result)
+        except BaseException as e:
+            self._fail(e)
+            while self._get(inbox) is not _END:
+                pass
+        finally:
+            stats.finished = perf_counter()
+            if outbox is not None:
+                self._put(outbox, _END)
+
+    def _put(self, queue: Queue, item):
+        while True:
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                if self._stop.is_set() and item is not _END:
+                    return
+
+    @staticmethod
+    def _get(queue: Queue):
+        while True:
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+
+    def _fail(self, error: BaseException):
+        self._errors.append(error)
+        self._stop.set()
@@ -0,0 +1,128 @@
+"""
+Compact pitch representation of a track:
+{
+    "format": "f32",
+    "segments": N,
+    "start": Binary(N little endian float64 segment start times in seconds),
+    "values": Binary(N x 12 little endian float32 pitch matrix, row major)
+}
+Older documents store the pitches as {"<segment start>": [12 floats], ...}, decode_pitches reads both.
+"""
+
+import os
+from typing import Tuple, List, Union
+
+import certifi
+import numpy as np
+from bson import Binary
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from pymongo.collection import Collection
+from pymongo.server_api import ServerApi
+
+PITCH_CLASSES = 12
+PITCH_FORMAT = "f32"
+
+
+def encode_pitches(starts: Union[List[float], np.ndarray], values: Union[List[List[float]], np.ndarray]) -> dict:
+    starts = np.asarray(starts, dtype="<f8")
+    values = np.asarray(values, dtype="<f4").reshape(-1, PITCH_CLASSES)
+    order = np.argsort(starts, kind="stable")
+    return encode_sorted_pitches(starts[order], values[order])
+
+
+def encode_sorted_pitches(starts: np.ndarray, values: np.ndarray) -> dict:
+    """
+    encode_pitches of segments that are already sorted by start time
+    """
+    return {
+        "format": PITCH_FORMAT,
+        "segments": len(starts),
+        "start": Binary(np.ascontiguousarray(starts, dtype="<f8").tobytes()),
+        "values": Binary(np.ascontiguousarray(values, dtype="<f4").tobytes()),
+    }
+
+
+def segment_arrays(segments) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: segment start times (N) and pitch matrix (N x 12) of the segments of a spotify audio analysis
+    """
+    return (np.array([segment.start for segment in segments], dtype=np.float64),
+            np.array([segment.pitches for segment in segments], dtype=np.float32).reshape(-1, PITCH_CLASSES))
+
+
+def is_compact(pitches) -> bool:
+    return isinstance(pitches, dict) and pitches.get("format") == PITCH_FORMAT
+
+
+def decode_pitches(pitches: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param pitches: compact or legacy pitches of a track document
+    :return: segment start times (N) and pitch matrix (N x 12) sorted by start time
+    """
+    if is_compact(pitches):
+        starts = np.frombuffer(pitches["start"], dtype="<f8")
+        values = np.frombuffer(pitches["values"], dtype="<f4").reshape(-1, PITCH_CLASSES)
+        return starts, values
+    starts = np.array([float(timestamp) for timestamp in pitches], dtype=np.float64)
+    values = np.array([pitches[timestamp] for timestamp in pitches], dtype=np.float32).reshape(-1, PITCH_CLASSES)
+    order = np.argsort(starts, kind="stable")
+    return starts[order], values[order]
+
+
+def resample(starts: np.ndarray, values: np.ndarray, steps: int = 100) -> np.ndarray:
+    """
+    Resample the pitches of a track onto a grid of steps, each step being 1/100 of the last segment start long.
+    Segments are averaged per step, steps without a segment are linearly interpolated.
+    :return: 12 x steps matrix, steps the track does not reach are NaN
+    """
+    resampled = np.full((PITCH_CLASSES, steps), np.nan)
+    if len(starts) == 0:
+        return resampled
+    nanoseconds = np.round(starts * 1e9).astype(np.int64)
+    width = int(starts[-1] * 10 // 1) * 1_000_000
+    if width <= 0:
+        return resampled
+    bins = (nanoseconds - nanoseconds[0]) // width
+    n_bins = int(bins[-1]) + 1
+    counts = np.bincount(bins, minlength=n_bins)
+    filled = np.flatnonzero(counts)
+    grid = np.arange(min(n_bins, steps))
+    for pitch in range(PITCH_CLASSES):
+        means = np.bincount(bins, weights=values[:, pitch], minlength=n_bins)[filled] / counts[filled]
+        resampled[pitch, :len(grid)] = np.interp(grid, filled, means)
+    return resampled
+
+
+def migrate(collection: Collection, batch_size: int = 500) -> int:
+    """
+    Rewrite all legacy pitch documents of a collection in the compact format
+    :return: number of migrated documents
+    """
+    migrated = 0
+    legacy = collection.find({"pitches": {"$type": "object"}, "pitches.format": {"$exists": False}},
+                             {"pitches": 1},
+                             batch_size=batch_size)
+    operations = []
+    for doc in legacy:
+        pitches = encode_pitches(*decode_pitches(doc["pitches"]))
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"pitches": pitches}}))
+        if len(operations) == batch_size:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+            print("migrated", migrated, "tracks")
+            operations = []
+    if len(operations) > 0:
+        migrated += collection.bulk_write(operations, ordered=False).modified_count
+    return migrated
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    mongo_uri = os.environ.get("MONGO_URL")
+    mongo_certificate = os.environ.get("MONGO_CERTIFICATE")
+    client = MongoClient(mongo_uri,
+                         tls=True,
+                         tlsCAFile=certifi.where(),
+                         tlsCertificateKeyFile=mongo_certificate,
+                         server_api=ServerApi('1'))
+    print("migrated", migrate(client['spotifai']['tracks']), "tracks in total")
@@ -1,37 +1,56 @@
-from time import sleep
-from typing import Union
+import logging
+from typing import Union, Optional
 
 from tekore import Spotify, Credentials, RefreshingCredentials
 from tekore.model import FullPlaylistTrack
 from tekore.model import PlaylistTrackPaging
 
+from project.metrics import METRICS
+from project.rate_limit import limiter_for
+
+logger = logging.getLogger(__name__)
+
 
 class PlaylistTracks:
+    limit: int = 50
+
     def __init__(self, spotify: Spotify, credentials: Union[Credentials, RefreshingCredentials]):
         self.spotify = spotify
         self.credentials = credentials
 
     def playlist_tracks(self, playlist_id: str, offset: int = 0):
+        for _, tracks in self.playlist_pages(playlist_id, offset):
+            yield tracks
+
+    def playlist_pages(self, playlist_id: str, offset: int = 0, end: Optional[int] = None):
+        """
+        :param end: offset at which to stop, the whole playlist is read if None
+        :return: generator of (offset, tracks) for every page of the playlist
+        """
         completed = False
-        limit = 50
+        limiter = limiter_for("api.spotify.com")
 
-        while not completed:
-            print('loading playlist', playlist_id, 'offset:', offset)
+        while not completed and (end is None or offset < end):
+            logger.info("loading playlist %s offset %d", playlist_id, offset,
+                        extra={"playlist_id": playlist_id, "offset": offset})
+            limit = self.limit if end is None else min(self.limit, end - offset)
             try:
-                playlist_page: Union[PlaylistTrackPaging, dict] = self.spotify.playlist_items(
+                # the limiter retries 429, 5xx and transport errors, whatever it raises is final
+                playlist_page: Union[PlaylistTrackPaging, dict] = limiter.call(
+                    self.spotify.playlist_items,
                     playlist_id=playlist_id,
                     offset=offset,
                     limit=limit
                 )
-                if len(playlist_page.items) == 0:
-                    completed = True
-                else:
-                    yield [item.track for item in playlist_page.items if isinstance(item.track, FullPlaylistTrack)]
-                    completed = False
-
-                offset += limit
             except Exception as e:
-                print('Error while fetching playlist tracks: ', e)
-                completed = False
-                sleep(3)
+                METRICS.increment("playlist_page_errors")
+                logger.warning("error while fetching playlist tracks: %s", e,
+                               extra={"playlist_id": playlist_id, "offset": offset})
+                raise
+            if len(playlist_page.items) == 0:
+                completed = True
+            else:
+                yield offset, [item.track for item in playlist_page.items
+                               if isinstance(item.track, FullPlaylistTrack)]
 
+            offset += limit
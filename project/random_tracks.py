@@ -1,17 +1,176 @@
+import hashlib
+import logging
+import math
 import random
-from typing import Union, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Union, List, Iterable, Optional, Iterator
 
+import numpy as np
+from pymongo.collection import Collection
 from tekore import Spotify, Credentials, RefreshingCredentials
 from tekore._model import FullTrack
 
+from project.metrics import METRICS
+from project.rate_limit import limiter_for
+
+CHARACTERS = "abcdefghijklmnopqrstuvwxyz0123456789"
+MARKETS = ["US", "GB", "DE", "AT", "CH", "FR", "ES", "IT", "NL", "SE", "BR", "MX", "AR", "JP", "KR", "AU", "CA", "IN"]
+FIRST_YEAR = 1950
+MAX_SEARCH_OFFSET = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    Set of strings in a fixed amount of memory. Membership tests may report false positives at about
+    error_rate once capacity items were added, never false negatives.
+    """
+    capacity: int
+    error_rate: float
+    size: int
+    hashes: int
+    _bits: np.ndarray
+
+    def __init__(self, capacity: int = 1_000_000, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def add(self, key: str) -> bool:
+        """
+        :return: True if the key was not contained before
+        """
+        positions = self._positions(key)
+        masks = np.left_shift(1, positions % 8).astype(np.uint8)
+        bytes_ = positions // 8
+        added = bool(np.any(self._bits[bytes_] & masks == 0))
+        np.bitwise_or.at(self._bits, bytes_, masks)
+        return added
+
+    def update(self, keys: Iterable[str]):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        positions = self._positions(key)
+        return bool(np.all(self._bits[positions // 8] & np.left_shift(1, positions % 8).astype(np.uint8)))
+
+    def _positions(self, key: str) -> np.ndarray:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return np.array([(first + i * second) % self.size for i in range(self.hashes)], dtype=np.int64)
+
+
+def stored_track_ids(collection: Collection, capacity: int = 1_000_000) -> BloomFilter:
+    """
+    :return: filter of the ids of all tracks in the collection
+    """
+    seen = BloomFilter(max(capacity, 2 * collection.estimated_document_count()))
+    seen.update(doc["id"] for doc in collection.find({}, {"id": 1, "_id": 0}) if "id" in doc)
+    return seen
+
+
+class SampleStats:
+    requests: int
+    fetched: int
+    new: int
+
+    def __init__(self):
+        self.requests = 0
+        self.fetched = 0
+        self.new = 0
+
+    def add(self, requests: int = 0, fetched: int = 0, new: int = 0):
+        self.requests += requests
+        self.fetched += fetched
+        self.new += new
+
+    @property
+    def requests_per_new_track(self) -> float:
+        return self.requests / self.new if self.new > 0 else math.inf
+
+    def __repr__(self):
+        return f"SampleStats(requests={self.requests}, " \
+               + f"fetched={self.fetched}, " \
+               + f"new={self.new}, " \
+               + f"requests_per_new_track={self.requests_per_new_track:.2f})"
+
 
 class RandomTracks:
+    """
+    Samples random tracks with searches spread over random prefixes, offsets, release years and markets
+    """
+    limit: int = 50
+
     def __init__(self, spotify: Spotify, credentials: Union[Credentials, RefreshingCredentials]):
         self.spotify = spotify
         self.credentials = credentials
+        self.stats = SampleStats()
 
     def random_tracks(self) -> List[FullTrack]:
-        start_char = random.choice("abcdefghijklmnopqrstuvwxyz")
-        tracks: List[FullTrack] = self.spotify.search(query=f"{start_char}%", limit=50)[0].items
-        return tracks
+        return next(self.sample(self.limit), [])
+
+    def sample(self, count: int, seen: Optional[BloomFilter] = None, concurrency: int = 8,
+               max_requests: Optional[int] = None) -> Iterator[List[FullTrack]]:
+        """
+        Stream pages of tracks that are neither in seen nor were sampled before
+        :param count: number of new tracks to sample
+        :param seen: ids of tracks to skip, e.g. stored_track_ids of the track collection. Sampled ids are added.
+        :param concurrency: number of searches in flight
+        :param max_requests: give up after this many searches, 20 searches per requested page by default
+        """
+        seen = seen if seen is not None else BloomFilter(max(1_000_000, 2 * count))
+        max_requests = max_requests if max_requests is not None else RandomTracks.max_requests(count)
+        limiter = limiter_for("api.spotify.com")
+        page: List[FullTrack] = []
+        sampled = 0
+        requests = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while sampled < count and requests < max_requests:
+                queries = [self.random_query() for _ in range(min(concurrency, max_requests - requests))]
+                requests += len(queries)
+                results = [executor.submit(limiter.call, self.spotify.search, query, market=market,
+                                           limit=self.limit, offset=offset)
+                           for query, market, offset in queries]
+                for (query, _, _), result in zip(queries, results):
+                    self.stats.add(requests=1)
+                    try:
+                        tracks = result.result()[0].items
+                    except Exception as e:
+                        METRICS.increment("search_errors")
+                        logger.warning("error while searching random tracks: %s", e,
+                                       extra={"query": query})
+                        continue
+                    self.stats.add(fetched=len(tracks))
+                    for track in tracks:
+                        if sampled < count and track is not None and seen.add(track.id):
+                            page.append(track)
+                            sampled += 1
+                    if len(page) >= self.limit:
+                        self.stats.add(new=len(page))
+                        yield page
+                        page = []
+        if len(page) > 0:
+            self.stats.add(new=len(page))
+            yield page
+
+    @staticmethod
+    def max_requests(count: int) -> int:
+        return 20 * math.ceil(count / RandomTracks.limit)
 
+    def random_query(self) -> tuple:
+        """
+        :return: (query, market, offset) of a random search
+        """
+        prefix = "".join(random.choices(CHARACTERS, k=random.choice([1, 2])))
+        query = f"{prefix}%"
+        if random.random() < 0.5:
+            query += f" year:{random.randint(FIRST_YEAR, date.today().year)}"
+        market = random.choice(MARKETS)
+        offset = random.randrange(0, MAX_SEARCH_OFFSET - self.limit + 1, self.limit)
+        return query, market, offset
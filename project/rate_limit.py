@@ -0,0 +1,355 @@
+import asyncio
+import random
+import threading
+from time import monotonic, sleep
+from typing import Optional, Callable, Any, Dict, Coroutine
+
+import httpx
+import requests
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Read the Retry-After header of a failed request
+    :param error: exception raised by tekore, httpx or requests
+    :return: seconds to wait or None if the response did not contain the header
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After", headers.get("retry-after"))
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def status_code(error: Exception) -> Optional[int]:
+    """
+    :return: http status of the response that caused the error, None if there was no response
+    """
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_transport_error(error: Exception) -> bool:
+    return isinstance(error, (httpx.TransportError, requests.ConnectionError, requests.Timeout))
+
+
+class RateLimiter:
+    """
+    Pause shared by all threads talking to the same api. As soon as one request is answered with
+    "Too Many Requests" every other request waits until the api accepts calls again.
+    """
+    default_wait: float
+    _resume_at: float
+    _lock: threading.Lock
+
+    def __init__(self, default_wait: float = 30):
+        self.default_wait = default_wait
+        self._resume_at = 0
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        with self._lock:
+            return max(0.0, self._resume_at - monotonic())
+
+    def throttle(self, seconds: Optional[float] = None):
+        if seconds is None:
+            seconds = self.default_wait
+        with self._lock:
+            self._resume_at = max(self._resume_at, monotonic() + seconds)
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average and bursts of up to capacity requests
+    """
+    rate: float
+    capacity: float
+    _tokens: float
+    _updated_at: float
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token without blocking
+        :return: seconds until the token may be used
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def set_rate(self, rate: float):
+        """
+        Change the rate, tokens gathered so far are kept
+        """
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self) -> float:
+        """
+        Take a token, blocks until one is available
+        :return: seconds waited
+        """
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker of a host is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after threshold consecutive 5xx responses or transport errors. While open, requests fail immediately,
+    after reset_after seconds a single probe request is let through to test the host again. The others keep
+    failing until the probe is answered, a failed probe opens the circuit again.
+    """
+    threshold: int
+    reset_after: float
+    failures: int
+    trips: int
+    _opened_at: Optional[float]
+    _probing: bool
+
+    def __init__(self, threshold: int = 20, reset_after: float = 60):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing or monotonic() - self._opened_at < self.reset_after:
+                raise CircuitOpenError(f"circuit open after {self.failures} consecutive failures")
+            self._probing = True
+
+    def record_success(self):
+        """
+        The host answered, also called for 4xx responses
+        """
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing:
+                self._probing = False
+                self._opened_at = monotonic()
+                self.trips += 1
+            elif self.failures >= self.threshold and self._opened_at is None:
+                self._opened_at = monotonic()
+                self.trips += 1
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter
+    """
+    max_retries: int
+    base: float
+    cap: float
+
+    def __init__(self, max_retries: int = 5, base: float = 1, cap: float = 60):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class LimiterMetrics:
+    calls: int
+    retries: int
+    rate_limited: int
+    failures: int
+    throttled_seconds: float
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.throttled_seconds = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self) -> dict:
+        return {"calls": self.calls,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "failures": self.failures,
+                "throttled_seconds": round(self.throttled_seconds, 3)}
+
+
+class RetryState:
+    """
+    Retries of a single call
+    """
+    not_found_retries: int
+    attempt: int
+    not_found: int
+
+    def __init__(self, not_found_retries: int = 0):
+        self.not_found_retries = not_found_retries
+        self.attempt = 0
+        self.not_found = 0
+
+
+class HostLimiter:
+    """
+    Rate limit and retry policy of a single host, shared by every client that talks to it
+    """
+    host: str
+    bucket: TokenBucket
+    pause: RateLimiter
+    breaker: CircuitBreaker
+    policy: RetryPolicy
+    metrics: LimiterMetrics
+
+    def __init__(self, host: str, rate: float = 10, capacity: float = 10,
+                 breaker: Optional[CircuitBreaker] = None, policy: Optional[RetryPolicy] = None):
+        self.host = host
+        self.bucket = TokenBucket(rate, capacity)
+        self.pause = RateLimiter()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.metrics = LimiterMetrics()
+
+    def call(self, func: Callable[..., Any], *args, not_found_retries: int = 0, **kwargs) -> Any:
+        """
+        Call func under the rate limit of the host. 429 responses pause every request to the host for
+        Retry-After seconds, transport errors and 5xx responses are retried with exponential backoff.
+        Both count against the max_retries of the policy.
+        :param not_found_retries: how often a 404 response is retried before the error is raised
+        """
+        state = RetryState(not_found_retries)
+        while True:
+            self.breaker.check()
+            sleep(self._admission_delay())
+            try:
+                result = func(*args, **kwargs)
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                sleep(self._retry_delay(e, state))
+
+    async def call_async(self, func: Callable[..., Coroutine], *args, not_found_retries: int = 0, **kwargs) -> Any:
+        """
+        Same as call for coroutine functions, waiting does not block the event loop
+        """
+        state = RetryState(not_found_retries)
+        while True:
+            self.breaker.check()
+            await asyncio.sleep(self._admission_delay())
+            try:
+                result = await func(*args, **kwargs)
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, state))
+
+    def _admission_delay(self) -> float:
+        delay = self.pause.remaining() + self.bucket.reserve()
+        self.metrics.add(calls=1, throttled_seconds=delay)
+        return delay
+
+    def _retry_delay(self, error: Exception, state: "RetryState") -> float:
+        """
+        :return: seconds to wait before the request is retried
+        :raises: the error if it must not be retried
+        """
+        status = status_code(error)
+        host_failed = is_transport_error(error) or (status is not None and status >= 500)
+        if not host_failed:
+            self.breaker.record_success()  # only 5xx responses and transport errors count for the breaker
+        if status == 429:
+            self.metrics.add(rate_limited=1)
+            if state.attempt >= self.policy.max_retries:
+                raise error
+            self.pause.throttle(retry_after(error) or self.policy.delay(state.attempt))
+            state.attempt += 1
+            return 0
+        if status == 404:
+            if state.not_found >= state.not_found_retries:
+                self.metrics.add(failures=1)
+                raise error
+            state.not_found += 1
+            self.metrics.add(retries=1)
+            return 0
+        if not host_failed:
+            raise error
+        self.breaker.record_failure()
+        self.metrics.add(failures=1)
+        if state.attempt >= self.policy.max_retries:
+            raise error
+        delay = self.policy.delay(state.attempt)
+        state.attempt += 1
+        self.metrics.add(retries=1, throttled_seconds=delay)
+        return delay
+
+    def backoff(self, attempt: int):
+        delay = self.policy.delay(attempt)
+        self.metrics.add(retries=1, throttled_seconds=delay)
+        sleep(delay)
+
+    async def backoff_async(self, attempt: int):
+        delay = self.policy.delay(attempt)
+        self.metrics.add(retries=1, throttled_seconds=delay)
+        await asyncio.sleep(delay)
+
+
+DEFAULT_LIMITS = {
+    "api.spotify.com": {"rate": 10, "capacity": 20},
+    "www.last.fm": {"rate": 5, "capacity": 5},
+    "ws.audioscrobbler.com": {"rate": 5, "capacity": 5},
+}
+
+_limiters: Dict[str, HostLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(host: str) -> HostLimiter:
+    """
+    :return: the limiter shared by all clients of the host
+    """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, **DEFAULT_LIMITS.get(host, {}))
+        return _limiters[host]
+
+
+def limiter_metrics() -> Dict[str, dict]:
+    with _limiters_lock:
+        return {host: {**limiter.metrics.to_dict(), "breaker_trips": limiter.breaker.trips}
+                for host, limiter in _limiters.items()}
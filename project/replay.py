@@ -0,0 +1,371 @@
+"""
+Record and replay the http traffic of a crawl, so it can be repeated offline.
+
+A cassette is a json file holding the responses of every request, keyed on the request:
+{"meta": {...}, "spotify": {key: [response, ...]}, "lastfm": {...}, "pylast": {...}}
+meta holds whatever the recording script needs to repeat the crawl. Requests that were sent several times
+are answered with their responses in the recorded order, the last response is repeated once they are used up.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+import requests
+import tekore as tk
+from bson import json_util
+from requests.adapters import HTTPAdapter, BaseAdapter
+
+from project.fake_spotify import fake_token
+
+
+class MissingRecording(LookupError):
+    """
+    Raised when a replayed request was not recorded
+    """
+
+
+class Cassette:
+    path: str
+    recordings: Dict[str, Dict[str, List]]
+    calls: Dict[str, int]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.recordings = {}
+        self.calls = {}
+        self._played: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as infile:
+                self.recordings = json.load(infile)
+
+    def record(self, kind: str, key: str, response):
+        with self._lock:
+            self.recordings.setdefault(kind, {}).setdefault(key, []).append(response)
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def play(self, kind: str, key: str):
+        with self._lock:
+            responses = self.recordings.get(kind, {}).get(key)
+            if responses is None:
+                raise MissingRecording(f"{kind} request {key} was not recorded")
+            played = self._played.get((kind, key), 0)
+            self._played[(kind, key)] = played + 1
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            return responses[min(played, len(responses) - 1)]
+
+    def save(self):
+        with self._lock:
+            with open(self.path, "w") as outfile:
+                json.dump(self.recordings, outfile)
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+UNORDERED_PARAMS = {"additional_types", "type"}
+
+
+def request_key(method: str, url: str, params: Optional[dict] = None, body=None) -> str:
+    """
+    :param params: query parameters, the comma separated values of UNORDERED_PARAMS are sorted as tekore builds
+    them from sets
+    """
+    params = {key: ",".join(sorted(value.split(","))) if key in UNORDERED_PARAMS and isinstance(value, str) else value
+              for key, value in (params or {}).items()}
+    query = urllib.parse.urlencode(sorted(params.items()))
+    key = f"{method} {url}"
+    if query != "":
+        key += ("&" if "?" in url else "?") + query
+    if body is not None:
+        key += " " + json.dumps(body, sort_keys=True)
+    return key
+
+
+def _tekore_key(request: tk.Request) -> str:
+    return request_key(request.method, request.url, request.params, request.json or request.data or request.content)
+
+
+class RecordingSender(tk.Sender):
+    """
+    Sends the requests of a tekore client with sender and records the responses
+    """
+    cassette: Cassette
+    sender: tk.Sender
+
+    def __init__(self, cassette: Cassette, sender: Optional[tk.Sender] = None):
+        self.cassette = cassette
+        self.sender = sender if sender is not None else tk.SyncSender()
+
+    @property
+    def is_async(self) -> bool:
+        return False
+
+    def close(self):
+        self.sender.close()
+
+    def send(self, request: tk.Request) -> tk.Response:
+        response = self.sender.send(request)
+        self.cassette.record("spotify", _tekore_key(request), {"url": response.url,
+                                                              "headers": dict(response.headers),
+                                                              "status_code": response.status_code,
+                                                              "content": response.content})
+        return response
+
+
+class ReplayingSender(tk.Sender):
+    """
+    Answers the requests of a tekore client from a cassette
+    """
+    cassette: Cassette
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+
+    def send(self, request: tk.Request) -> tk.Response:
+        recorded = self.cassette.play("spotify", _tekore_key(request))
+        return tk.Response(recorded["url"], recorded["headers"], recorded["status_code"], recorded["content"])
+
+    @property
+    def is_async(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+def _requests_key(request: requests.PreparedRequest) -> str:
+    """
+    Key on the path only, so traffic recorded from a redirected session replays against the real host
+    """
+    url = urllib.parse.urlsplit(request.url)
+    return request_key(request.method, url.path + ("?" + url.query if url.query else ""))
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Transport adapter of a requests session that records the responses, mount it with session.mount("https://", ...)
+    """
+    cassette: Cassette
+
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.cassette.record("lastfm", _requests_key(request), {"status_code": response.status_code,
+                                                                "headers": dict(response.headers),
+                                                                "text": response.text})
+        return response
+
+
+class ReplayingAdapter(BaseAdapter):
+    """
+    Transport adapter of a requests session that answers from a cassette
+    """
+    cassette: Cassette
+
+    def __init__(self, cassette: Cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        recorded = self.cassette.play("lastfm", _requests_key(request))
+        response = requests.Response()
+        response.status_code = recorded["status_code"]
+        response.headers.update(recorded["headers"])
+        response.headers.pop("Content-Encoding", None)
+        response._content = recorded["text"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def recording_session(cassette: Cassette, session: Optional[requests.Session] = None) -> requests.Session:
+    session = session if session is not None else requests.Session()
+    session.mount("https://", RecordingAdapter(cassette))
+    session.mount("http://", RecordingAdapter(cassette))
+    return session
+
+
+def replaying_session(cassette: Cassette) -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", ReplayingAdapter(cassette))
+    session.mount("http://", ReplayingAdapter(cassette))
+    return session
+
+
+class _TopItem:
+    """
+    Stand-in for pylast.TopItem, tags only need item.name
+    """
+
+    def __init__(self, name: str, weight: int):
+        self.item = type("Tag", (), {"name": name})()
+        self.weight = weight
+
+
+class _Track:
+    def __init__(self, network, artist: str, title: str):
+        self._network = network
+        self._artist = artist
+        self._title = title
+
+    def get_top_tags(self, limit=None):
+        return self._network.top_tags(self._artist, self._title, limit)
+
+
+class RecordingNetwork:
+    """
+    Wraps a pylast.LastFMNetwork and records the top tags of the tracks that are looked up
+    """
+
+    def __init__(self, network, cassette: Cassette):
+        self.network = network
+        self.cassette = cassette
+
+    def get_track(self, artist: str, title: str) -> _Track:
+        return _Track(self, artist, title)
+
+    def top_tags(self, artist: str, title: str, limit=None):
+        key = request_key("get_top_tags", f"{artist}\x1f{title}", {"limit": limit} if limit else None)
+        try:
+            top_tags = self.network.get_track(artist, title).get_top_tags(limit=limit)
+        except Exception as e:
+            self.cassette.record("pylast", key, {"error": str(e)})
+            raise
+        self.cassette.record("pylast", key, {"tags": [[tag.item.name, int(tag.weight)] for tag in top_tags]})
+        return top_tags
+
+    def __getattr__(self, attr):
+        return getattr(self.network, attr)
+
+
+class ReplayingNetwork:
+    """
+    Stand-in for pylast.LastFMNetwork answering top tag lookups from a cassette
+    """
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+
+    def get_track(self, artist: str, title: str) -> _Track:
+        return _Track(self, artist, title)
+
+    def top_tags(self, artist: str, title: str, limit=None):
+        recorded = self.cassette.play("pylast", request_key("get_top_tags", f"{artist}\x1f{title}",
+                                                            {"limit": limit} if limit else None))
+        if "error" in recorded:
+            raise LookupError(recorded["error"])
+        return [_TopItem(name, weight) for name, weight in recorded["tags"]]
+
+
+class BulkResult:
+    matched_count: int
+    modified_count: int
+    upserted_count: int
+
+    def __init__(self, matched_count: int, modified_count: int, upserted_count: int):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_count = upserted_count
+
+
+class SqliteCollection:
+    """
+    Local sink with the part of the pymongo collection api the crawler uses. bulk_write understands the
+    TrackUpserts of AnalyzedTracks.upsert, a $set pipeline of $literal and $ifNull expressions filtered by id.
+    """
+    name: str
+
+    def __init__(self, connection: sqlite3.Connection, name: str, lock: threading.Lock):
+        self.name = name
+        self._connection = connection
+        self._lock = lock
+        with self._lock:
+            self._connection.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (id TEXT PRIMARY KEY, document TEXT NOT NULL)')
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def bulk_write(self, operations, ordered: bool = True) -> BulkResult:
+        matched = modified = upserted = 0
+        with self._lock, self._connection:
+            for operation in operations:
+                track_id = operation.filter["id"]
+                row = self._connection.execute(f'SELECT document FROM "{self.name}" WHERE id = ?',
+                                               (track_id,)).fetchone()
+                stored = json_util.loads(row[0]) if row is not None else {"id": track_id}
+                updated = dict(stored)
+                for stage in operation.pipeline:
+                    for key, expression in stage["$set"].items():
+                        updated[key] = SqliteCollection._evaluate(expression, stored)
+                if row is None:
+                    upserted += 1
+                else:
+                    matched += 1
+                    modified += updated != stored
+                self._connection.execute(f'INSERT OR REPLACE INTO "{self.name}" (id, document) VALUES (?, ?)',
+                                         (track_id, json_util.dumps(updated)))
+        return BulkResult(matched, modified, upserted)
+
+    def find(self, filter: Optional[dict] = None, projection: Optional[dict] = None, **kwargs):
+        with self._lock:
+            rows = self._connection.execute(f'SELECT document FROM "{self.name}"').fetchall()
+        for row in rows:
+            document = json_util.loads(row[0])
+            if all(document.get(key) == value for key, value in (filter or {}).items()):
+                yield document
+
+    def estimated_document_count(self) -> int:
+        with self._lock:
+            return self._connection.execute(f'SELECT COUNT(*) FROM "{self.name}"').fetchone()[0]
+
+    @staticmethod
+    def _evaluate(expression, stored: dict):
+        if "$literal" in expression:
+            return expression["$literal"]
+        field, default = expression["$ifNull"]
+        value = stored.get(field[1:])
+        return value if value is not None else SqliteCollection._evaluate(default, stored)
+
+
+class SqliteDatabase:
+    """
+    Database of SqliteCollections in a single SQLite file
+    """
+    path: str
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._collections: Dict[str, SqliteCollection] = {}
+
+    def __getitem__(self, name: str) -> SqliteCollection:
+        if name not in self._collections:
+            self._collections[name] = SqliteCollection(self._connection, name, self._lock)
+        return self._collections[name]
+
+    def close(self):
+        self._connection.close()
+
+
+def recording_spotify(cassette: Cassette, spotify: tk.Spotify) -> tk.Spotify:
+    """
+    :return: client with the token of spotify that records its traffic
+    """
+    return tk.Spotify(spotify.token, sender=RecordingSender(cassette))
+
+
+def replaying_spotify(cassette: Cassette) -> tk.Spotify:
+    return tk.Spotify(fake_token(), sender=ReplayingSender(cassette))
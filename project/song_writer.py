@@ -0,0 +1,120 @@
+import os
+from typing import List, Optional, Set
+
+import numpy as np
+import pandas as pd
+
+
+class CsvSongWriter:
+    """
+    Appends exported batches to a single csv file
+    """
+    path: str
+
+    def __init__(self, path: str = "songs.csv"):
+        self.path = path
+
+    def write(self, df: pd.DataFrame) -> str:
+        """
+        :return: the file the batch was written to
+        """
+        with open(self.path, 'a') as f:
+            df.to_csv(f, mode='a', header=f.tell() == 0, index=False)
+        return self.path
+
+    def close(self):
+        pass
+
+
+class ParquetSongWriter:
+    """
+    Writes exported batches into a directory of parquet partitions. Every batch becomes a row group,
+    a new partition file is started after batches_per_partition batches. Pitch columns are stored as float32
+    and the track id is kept as "id" column.
+    """
+    path: str
+    batches_per_partition: int
+    float32_columns: List[str]
+
+    def __init__(self, path: str = "songs.parquet", batches_per_partition: int = 25,
+                 float32_columns: Optional[List[str]] = None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("pyarrow is required to export parquet files: pip install pyarrow") from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self.batches_per_partition = batches_per_partition
+        self.float32_columns = float32_columns if float32_columns is not None else []
+        self._writer = None
+        self._schema = None
+        self._batches = 0
+        os.makedirs(path, exist_ok=True)
+        self._partition = max([int(name[len("part-"):-len(".parquet")]) for name in partitions(path)], default=-1) + 1
+
+    def write(self, df: pd.DataFrame) -> str:
+        """
+        :return: name of the partition the batch was written to
+        """
+        df = df.astype({column: np.float32 for column in self.float32_columns if column in df.columns})
+        df = df.rename_axis("id").reset_index()
+        df["id"] = df["id"].astype(str)
+        if self._schema is not None:
+            df = df.reindex(columns=self._schema.names)
+        table = self._pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        partition = f"part-{self._partition:05d}.parquet"
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = self._pq.ParquetWriter(os.path.join(self.path, partition), self._schema)
+        self._writer.write_table(table)
+        self._batches += 1
+        if self._batches >= self.batches_per_partition:
+            self._roll()
+        return partition
+
+    def remove_rows(self, partition: str, ids: Set[str]):
+        """
+        Rewrite a partition without the rows of the given track ids, the partition is deleted if no rows remain
+        """
+        import pyarrow.compute as pc
+        partition_path = os.path.join(self.path, partition)
+        if not os.path.exists(partition_path):
+            return
+        table = self._pq.read_table(partition_path)
+        kept = table.filter(pc.invert(pc.is_in(table["id"], value_set=self._pa.array(list(ids), self._pa.string()))))
+        if kept.num_rows == table.num_rows:
+            return
+        if kept.num_rows == 0:
+            os.remove(partition_path)
+            return
+        temporary_path = partition_path + ".tmp"
+        self._pq.write_table(kept, temporary_path)
+        os.replace(temporary_path, partition_path)
+
+    def close(self):
+        if self._writer is not None:
+            self._roll()
+
+    def _roll(self):
+        self._writer.close()
+        self._writer = None
+        self._batches = 0
+        self._partition += 1
+
+
+def partitions(path: str) -> List[str]:
+    return sorted(name for name in os.listdir(path) if name.startswith("part-") and name.endswith(".parquet"))
+
+
+def load_songs(path: str = "songs.parquet", columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Load exported songs, parquet partitions are read memory mapped
+    :param path: parquet directory or csv file
+    :param columns: only load these columns
+    """
+    if path.endswith(".csv"):
+        return pd.read_csv(path, usecols=columns)
+    import pyarrow.parquet as pq
+    return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
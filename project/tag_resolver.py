@@ -0,0 +1,75 @@
+from typing import List, Dict, Optional, Iterable
+
+import numpy as np
+from pymongo.collection import Collection
+
+
+class TagResolver:
+    """
+    Maps raw last.fm tags onto the allowed tag vocabulary. Tags are matched case-insensitively with
+    hyphens, underscores and repeated whitespace folded, so "Hip-Hop" and "hip hop" resolve to the same tag.
+    Tags outside of the vocabulary resolve to misc, which always has id 0.
+    """
+    tags: List[str]
+    misc: str
+    _lookup: Dict[str, int]
+
+    def __init__(self, allowed_tags: Iterable[str], aliases: Optional[Dict[str, str]] = None, misc: str = "misc"):
+        """
+        :param allowed_tags: vocabulary of canonical tags
+        :param aliases: alternative spelling -> canonical tag
+        :param misc: tag assigned to everything outside of the vocabulary
+        """
+        self.misc = misc
+        self.tags = [misc] + sorted({tag for tag in allowed_tags if TagResolver.normalise(tag) != misc})
+        self._lookup = {TagResolver.normalise(tag): tag_id for tag_id, tag in enumerate(self.tags)}
+        for alias, tag in (aliases or {}).items():
+            self._lookup[TagResolver.normalise(alias)] = self._lookup[TagResolver.normalise(tag)]
+
+    @classmethod
+    def from_collection(cls, collection: Collection, misc: str = "misc") -> "TagResolver":
+        """
+        Load the vocabulary from documents of the form {"tag": "...", "aliases": ["...", ...]}, aliases are optional
+        """
+        allowed_tags = []
+        aliases = {}
+        for doc in collection.find({}, {"tag": 1, "aliases": 1}):
+            allowed_tags.append(doc["tag"])
+            for alias in doc.get("aliases", []):
+                aliases[alias] = doc["tag"]
+        return cls(allowed_tags, aliases, misc)
+
+    @staticmethod
+    def normalise(tag: str) -> str:
+        return " ".join(tag.casefold().replace("-", " ").replace("_", " ").split())
+
+    def resolve(self, tags: List[str]) -> List[int]:
+        return self.resolve_many([tags])[0]
+
+    def resolve_many(self, tag_lists: List[Optional[List[str]]]) -> List[List[int]]:
+        """
+        Resolve the tags of many tracks at once, every distinct tag string is normalised only once
+        :param tag_lists: tags of every track, None for tracks without tags
+        :return: sorted unique tag ids of every track
+        """
+        tag_lists = [tags if isinstance(tags, list) else [] for tags in tag_lists]
+        lengths = np.array([len(tags) for tags in tag_lists], dtype=np.int64)
+        flat = np.array([tag for tags in tag_lists for tag in tags], dtype=object)
+        if len(flat) == 0:
+            return [[] for _ in tag_lists]
+        distinct, inverse = np.unique(flat, return_inverse=True)
+        distinct_ids = np.array([self._lookup.get(TagResolver.normalise(tag), 0) for tag in distinct], dtype=np.int64)
+        rows = np.repeat(np.arange(len(tag_lists), dtype=np.int64), lengths)
+        pairs = np.unique(rows * len(self.tags) + distinct_ids[inverse])
+        pair_rows = pairs // len(self.tags)
+        splits = np.searchsorted(pair_rows, np.arange(1, len(tag_lists)))
+        return [ids.tolist() for ids in np.split(pairs % len(self.tags), splits)]
+
+    def names(self, tag_ids: List[int]) -> List[str]:
+        return [self.tags[tag_id] for tag_id in tag_ids]
+
+    def resolve_names_many(self, tag_lists: List[Optional[List[str]]]) -> List[List[str]]:
+        return [self.names(tag_ids) for tag_ids in self.resolve_many(tag_lists)]
+
+    def __len__(self):
+        return len(self.tags)
@@ -0,0 +1,67 @@
+"""
+Run from the project directory: python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("pyarrow")
+
+from export import ExportManifest, export, pitch_feature_columns  # noqa: E402
+from pitches import encode_pitches  # noqa: E402
+from song_writer import ParquetSongWriter, load_songs, partitions  # noqa: E402
+
+
+def fake_tracks(n_tracks: int):
+    rng = np.random.default_rng(42)
+    return [{"id": f"track{i:03d}",
+             "name": f"Track {i}",
+             "tempo": 120.0 + i,
+             "pitches": encode_pitches(np.cumsum(rng.random(20)), rng.random((20, 12)).astype(np.float32))}
+            for i in range(n_tracks)]
+
+
+def run_export(collection, path: str):
+    writer = ParquetSongWriter(path, float32_columns=pitch_feature_columns())
+    export(collection, writer, manifest=ExportManifest(os.path.join(path, "_manifest.json")))
+
+
+def snapshot(path: str):
+    with open(os.path.join(path, "_manifest.json")) as infile:
+        manifest = json.load(infile)
+    files = {name: os.path.getmtime(os.path.join(path, name)) for name in partitions(path)}
+    return manifest, files
+
+
+def test_unchanged_tracks_stay_exported(tmp_path):
+    collection = mongomock.MongoClient().db.tracks
+    collection.insert_many(fake_tracks(30))
+    path = str(tmp_path / "songs.parquet")
+
+    run_export(collection, path)
+    manifest, files = snapshot(path)
+    assert len(manifest) == 30
+    run_export(collection, path)
+
+    assert snapshot(path) == (manifest, files)
+    assert sorted(load_songs(path, columns=["id"])["id"]) == [f"track{i:03d}" for i in range(30)]
+
+
+def test_only_the_newest_duplicate_is_exported(tmp_path):
+    collection = mongomock.MongoClient().db.tracks
+    collection.insert_many(fake_tracks(3))
+    collection.insert_one(dict(fake_tracks(1)[0], tempo=200.0))
+    path = str(tmp_path / "songs.parquet")
+
+    run_export(collection, path)
+
+    songs = load_songs(path, columns=["id", "tempo"]).set_index("id")
+    assert len(songs) == 3
+    assert songs.loc["track000", "tempo"] == 200.0
@@ -1,10 +1,18 @@
-from typing import List, Set
+from typing import List, Set, Optional, Tuple
 
+import numpy as np
 from google.cloud.firestore_v1 import CollectionReference, DocumentReference
+from pymongo import UpdateOne
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 from tekore._model import FullTrack, FullArtist
 
 from lastfm import LastFmProxy
+from pitches import PITCH_CLASSES, encode_sorted_pitches, decode_pitches
+from util import index_by_id, Partition
+
+AUDIO_FEATURES = ["acousticness", "pitches", "energy", "danceability", "mode", "instrumentalness", "key",
+                  "liveness", "loudness", "tempo", "time_signature", "valence"]
 
 
 class TaggedTrack:
@@ -18,33 +26,84 @@ class TaggedTrack:
         self.lastfm = lastfm
 
     def tags(self) -> List[str]:
-        tags = set()
-        i = 0
-        while len(tags) == 0 and i < len(self.artist_names):
-            tags = self.lastfm.get_tags(self.artist_names[i], self.name)
-            i += 1
-        return list(tags)
+        return TaggedTrack.tags_many(self.lastfm, [self])[0]
+
+    @staticmethod
+    def tags_many(lastfm: LastFmProxy, tagged_tracks: List["TaggedTrack"]) -> List[List[str]]:
+        """
+        Retrieve the tags of many tracks with one batch request per round.
+        Every round asks for the next artist of the tracks that have no tags yet.
+        """
+        rounds = TagRounds(tagged_tracks)
+        while not rounds.finished():
+            rounds.add(lastfm.get_tags_many(rounds.pairs()))
+        return [list(track_tags) for track_tags in rounds.tags]
+
+
+class TagRounds:
+    """
+    Rounds of the tag lookups of many tracks, see TaggedTrack.tags_many. The lookups themselves are left to the
+    caller, so the rounds can be driven by a blocking or an asynchronous client.
+    """
+    tags: List[Set[str]]
+
+    def __init__(self, tracks: list):
+        """
+        :param tracks: tracks with a name and artist_names
+        """
+        self._tracks = tracks
+        self.tags = [set() for _ in tracks]
+        self._pending = [i for i, track in enumerate(tracks) if len(track.artist_names) > 0]
+        self._artist_index = 0
+
+    def finished(self) -> bool:
+        return len(self._pending) == 0
+
+    def pairs(self) -> List[Tuple[str, str]]:
+        """
+        :return: (artist, track) lookups of the current round
+        """
+        return [(self._tracks[i].artist_names[self._artist_index], self._tracks[i].name) for i in self._pending]
+
+    def add(self, tags: List[Set[str]]):
+        """
+        :param tags: tags of the lookups of the current round, in the order of pairs
+        """
+        for i, track_tags in zip(self._pending, tags):
+            self.tags[i] = track_tags
+        self._artist_index += 1
+        self._pending = [i for i in self._pending
+                         if len(self.tags[i]) == 0 and self._artist_index < len(self._tracks[i].artist_names)]
 
 
 class AnalyzedTrack:
+    """
+    Track of a crawled page. Fields that are filled in by later stages are None until then, the pitches are
+    kept as sorted numpy arrays and only encoded by to_document.
+    """
+    __slots__ = ("id", "name", "duration", "artist_genres", "artist_names", "tags", "tag_ids",
+                 "acousticness", "energy", "danceability", "mode", "instrumentalness", "key", "liveness",
+                 "loudness", "tempo", "time_signature", "valence", "pitch_starts", "pitch_values")
     id: str
     name: str
     duration: float
     artist_genres: List[str]
     artist_names: List[str]
-    tags: List[str]
-    acousticness: float
-    pitches: dict
-    energy: float
-    danceability: float
-    mode: int
-    instrumentalness: float
-    key: int
-    liveness: float
-    loudness: float
-    tempo: float
-    time_signature: int
-    valence: float
+    tags: Optional[List[str]]
+    tag_ids: Optional[List[int]]
+    acousticness: Optional[float]
+    energy: Optional[float]
+    danceability: Optional[float]
+    mode: Optional[int]
+    instrumentalness: Optional[float]
+    key: Optional[int]
+    liveness: Optional[float]
+    loudness: Optional[float]
+    tempo: Optional[float]
+    time_signature: Optional[int]
+    valence: Optional[float]
+    pitch_starts: Optional[np.ndarray]
+    pitch_values: Optional[np.ndarray]
 
     def __init__(self,
                  full_track: FullTrack,
@@ -52,18 +111,74 @@ class AnalyzedTrack:
         self.id = full_track.id
         self.name = full_track.name
         self.duration = full_track.duration_ms
-        self.artist_genres = list({genre for artist in artists
-                                   for genre in artist.genres})
-        self.artist_names = list({artist.name for artist in artists})
+        self.artist_genres = list(dict.fromkeys(genre for artist in artists
+                                                for genre in artist.genres))
+        self.artist_names = list(dict.fromkeys(artist.name for artist in artists))
+        self.tags = None
+        self.tag_ids = None
+        self.acousticness = None
+        self.energy = None
+        self.danceability = None
+        self.mode = None
+        self.instrumentalness = None
+        self.key = None
+        self.liveness = None
+        self.loudness = None
+        self.tempo = None
+        self.time_signature = None
+        self.valence = None
+        self.pitch_starts = None
+        self.pitch_values = None
+
+    def set_pitches(self, starts: np.ndarray, values: np.ndarray):
+        """
+        :param starts: segment start times (N)
+        :param values: pitch matrix (N x 12)
+        """
+        starts = np.asarray(starts, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float32).reshape(-1, PITCH_CLASSES)
+        order = np.argsort(starts, kind="stable")
+        self.pitch_starts = starts[order]
+        self.pitch_values = values[order]
+
+    @property
+    def pitches(self) -> Optional[dict]:
+        """
+        Compact pitch document, see pitches.py
+        """
+        if self.pitch_starts is None:
+            return None
+        return encode_sorted_pitches(self.pitch_starts, self.pitch_values)
+
+    @pitches.setter
+    def pitches(self, pitches: Optional[dict]):
+        if pitches is None:
+            self.pitch_starts = self.pitch_values = None
+        else:
+            self.set_pitches(*decode_pitches(pitches))
+
+    def to_document(self) -> dict:
+        """
+        :return: fields of the track that are set, as stored in the tracks collection
+        """
+        document = {}
+        for field in AnalyzedTrack.__slots__[:-2]:  # the pitch arrays are encoded below
+            value = getattr(self, field)
+            if value is not None:
+                document[field] = value
+        if self.pitch_starts is not None:
+            document["pitches"] = self.pitches
+        return document
 
     def __repr__(self):
+        segments = len(self.pitch_starts) if self.pitch_starts is not None else None
         return f"AnalyzedTrack(id={self.id}, " \
                + f"name={self.name}, " \
-               + f"tags={self.tags}, " \
+               + f"tags={_truncate(self.tags)}, " \
                + f"duration={self.duration}, " \
-               + f"artist_genres={self.artist_genres}, " \
+               + f"artist_genres={_truncate(self.artist_genres)}, " \
                + f"acousticness={self.acousticness}, " \
-               + f"pitches={self.pitches}, " \
+               + f"pitches=<{segments} segments>, " \
                + f"energy={self.energy}, " \
                + f"danceability={self.danceability}, " \
                + f"mode={self.mode}, " \
@@ -76,20 +191,96 @@ class AnalyzedTrack:
                + f"valence={self.valence} )"
 
 
+def _truncate(values: Optional[list], limit: int = 5) -> str:
+    if values is None or len(values) <= limit:
+        return str(values)
+    return str(values[:limit])[:-1] + f", ... {len(values) - limit} more]"
+
+
+class TrackUpsert(UpdateOne):
+    """
+    Upsert of a track by its filter and update pipeline, which stay readable for sinks other than mongo
+    """
+    filter: dict
+    pipeline: List[dict]
+
+    def __init__(self, filter: dict, pipeline: List[dict]):
+        super().__init__(filter, pipeline, upsert=True)
+        self.filter = filter
+        self.pipeline = pipeline
+
+
+class UpsertSummary:
+    batch: int
+    matched: int
+    modified: int
+    upserted: int
+    errors: List[str]
+
+    def __init__(self, batch: int, matched: int, modified: int, upserted: int, errors: List[str] = None):
+        self.batch = batch
+        self.matched = matched
+        self.modified = modified
+        self.upserted = upserted
+        self.errors = errors if errors is not None else []
+
+    def __repr__(self):
+        return f"UpsertSummary(batch={self.batch}, " \
+               + f"matched={self.matched}, " \
+               + f"modified={self.modified}, " \
+               + f"upserted={self.upserted}, " \
+               + f"errors={len(self.errors)})"
+
+
 class AnalyzedTracks:
     tracks: List[AnalyzedTrack]
 
     def __init__(self, tracks: List[FullTrack], artists: List[FullArtist]):
+        artists_by_id = index_by_id(artists)
         self.tracks = [
-            AnalyzedTrack(track, [artist
-                                  for artist in artists
-                                  if artist.id in [a.id for a in track.artists]]
+            AnalyzedTrack(track, [artists_by_id[a.id]
+                                  for a in track.artists
+                                  if a.id in artists_by_id]
                           ) for track in tracks
         ]
 
-    def upsert(self, collection: Collection):
-        tracks = [track.__dict__ for track in self.tracks]
-        collection.insert_many(tracks)
+    def upsert(self, collection: Collection, batch_size: int = 500) -> List[UpsertSummary]:
+        """
+        Upsert the tracks keyed on their spotify id. Unordered bulk writes are used, so a bad document
+        only fails itself and not the rest of its batch.
+        :return: one summary per batch
+        """
+        summaries = []
+        for batch_index, batch in enumerate(Partition(self.tracks, batch_size)):
+            operations = [AnalyzedTracks._upsert_operation(track) for track in batch]
+            try:
+                result = collection.bulk_write(operations, ordered=False)
+                summaries.append(UpsertSummary(batch_index,
+                                               result.matched_count,
+                                               result.modified_count,
+                                               result.upserted_count))
+            except BulkWriteError as bwe:
+                details = bwe.details
+                summaries.append(UpsertSummary(batch_index,
+                                               details["nMatched"],
+                                               details["nModified"],
+                                               details["nUpserted"],
+                                               [error["errmsg"] for error in details["writeErrors"]]))
+        return summaries
+
+    @staticmethod
+    def _upsert_operation(track: AnalyzedTrack) -> "TrackUpsert":
+        """
+        Identity fields and tags are overwritten, audio features only fill in fields the stored track is missing
+        """
+        document = track.to_document()
+        fields = {}
+        for key, value in document.items():
+            if key in AUDIO_FEATURES:
+                fields[key] = {"$ifNull": [f"${key}", {"$literal": value}]}
+            else:
+                fields[key] = {"$literal": value}
+        return TrackUpsert({"id": track.id}, [{"$set": fields}])
 
     def __repr__(self):
         return f"AnalyzedTracks(tracks={self.tracks})"
@@ -1,5 +1,5 @@
 import math
-from typing import List, Any
+from typing import List, Any, Dict
 
 
 class Partition:
@@ -21,3 +21,13 @@ class Partition:
     def __len__(self):
         return math.ceil(len(self.items) / self.partition_size)
 
+
+def index_by_id(items: List[Any]) -> Dict[str, Any]:
+    """
+    Index items by their id attribute, the first occurrence of an id wins and None items are skipped
+    """
+    index = {}
+    for item in items:
+        if item is not None and item.id not in index:
+            index[item.id] = item
+    return index
@@ -0,0 +1,272 @@
+import json
+import sqlite3
+import threading
+from time import time
+from typing import List, Optional, Dict
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+
+from project.util import Partition
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class Lease:
+    """
+    Claim of a worker on a task. A task is either a range [offset, end) of a playlist or a batch of track ids.
+    """
+    task_id: str
+    worker: str
+    playlist_id: Optional[str]
+    offset: int
+    end: int
+    track_ids: List[str]
+    attempts: int
+
+    def __init__(self, task_id: str, worker: str, playlist_id: Optional[str] = None, offset: int = 0, end: int = 0,
+                 track_ids: Optional[List[str]] = None, attempts: int = 1):
+        self.task_id = task_id
+        self.worker = worker
+        self.playlist_id = playlist_id
+        self.offset = offset
+        self.end = end
+        self.track_ids = track_ids if track_ids is not None else []
+        self.attempts = attempts
+
+    def __repr__(self):
+        if len(self.track_ids) > 0:
+            return f"Lease(task_id={self.task_id}, worker={self.worker}, tracks={len(self.track_ids)})"
+        return f"Lease(task_id={self.task_id}, " \
+               + f"worker={self.worker}, " \
+               + f"playlist_id={self.playlist_id}, " \
+               + f"offset={self.offset}, " \
+               + f"end={self.end})"
+
+
+def playlist_ranges(total: int, range_size: int) -> List[tuple]:
+    return [(offset, min(offset + range_size, total)) for offset in range(0, total, range_size)]
+
+
+class LocalLeaseQueue:
+    """
+    Work queue in a SQLite file, shared by crawler processes on the same machine.
+    Leases expire after lease_seconds unless they are renewed, expired tasks are handed to the next worker.
+    A task is given up after max_attempts claims.
+    """
+    path: str
+    lease_seconds: float
+    max_attempts: int
+
+    def __init__(self, path: str = ".crawl_queue.sqlite", lease_seconds: float = 300, max_attempts: int = 5):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                                 "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                 "playlist_id TEXT, "
+                                 "start INTEGER NOT NULL DEFAULT 0, "
+                                 "end INTEGER NOT NULL DEFAULT 0, "
+                                 "track_ids TEXT NOT NULL DEFAULT '[]', "
+                                 "state TEXT NOT NULL, "
+                                 "worker TEXT, "
+                                 "lease_until REAL NOT NULL DEFAULT 0, "
+                                 "attempts INTEGER NOT NULL DEFAULT 0, "
+                                 "error TEXT)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+
+    def add_playlist(self, playlist_id: str, total: int, range_size: int = 500) -> int:
+        """
+        Split a playlist of total tracks into ranges of range_size tracks
+        :return: number of added tasks
+        """
+        ranges = playlist_ranges(total, range_size)
+        with self._lock:
+            self._connection.executemany("INSERT INTO tasks (playlist_id, start, end, state) VALUES (?, ?, ?, ?)",
+                                         [(playlist_id, offset, end, PENDING) for offset, end in ranges])
+        return len(ranges)
+
+    def add_tracks(self, track_ids: List[str], batch_size: int = 50) -> int:
+        batches = list(Partition(track_ids, batch_size))
+        with self._lock:
+            self._connection.executemany("INSERT INTO tasks (track_ids, state) VALUES (?, ?)",
+                                         [(json.dumps(batch), PENDING) for batch in batches])
+        return len(batches)
+
+    def claim(self, worker: str) -> Optional[Lease]:
+        """
+        :return: the oldest pending or expired task, None if there is nothing to do right now
+        """
+        now = time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute("UPDATE tasks SET state = ?, worker = NULL "
+                                         "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                                         (FAILED, LEASED, now, self.max_attempts))
+                row = self._connection.execute("SELECT id, playlist_id, start, end, track_ids, attempts FROM tasks "
+                                               "WHERE state = ? OR (state = ? AND lease_until < ?) "
+                                               "ORDER BY id LIMIT 1",
+                                               (PENDING, LEASED, now)).fetchone()
+                if row is not None:
+                    self._connection.execute("UPDATE tasks SET state = ?, worker = ?, lease_until = ?, "
+                                             "attempts = attempts + 1 WHERE id = ?",
+                                             (LEASED, worker, now + self.lease_seconds, row[0]))
+                self._connection.execute("INSERT OR REPLACE INTO workers (worker, seen_at) VALUES (?, ?)",
+                                         (worker, now))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        task_id, playlist_id, offset, end, track_ids, attempts = row
+        return Lease(str(task_id), worker, playlist_id, offset, end, json.loads(track_ids), attempts + 1)
+
+    def renew(self, lease: Lease) -> bool:
+        """
+        :return: False if the lease expired and was claimed by another worker
+        """
+        now = time()
+        with self._lock:
+            renewed = self._connection.execute("UPDATE tasks SET lease_until = ? "
+                                               "WHERE id = ? AND worker = ? AND state = ?",
+                                               (now + self.lease_seconds, int(lease.task_id), lease.worker,
+                                                LEASED)).rowcount == 1
+            self._connection.execute("INSERT OR REPLACE INTO workers (worker, seen_at) VALUES (?, ?)",
+                                     (lease.worker, now))
+        return renewed
+
+    def complete(self, lease: Lease):
+        with self._lock:
+            self._connection.execute("UPDATE tasks SET state = ?, error = NULL WHERE id = ? AND worker = ?",
+                                     (DONE, int(lease.task_id), lease.worker))
+
+    def release(self, lease: Lease, error: Optional[str] = None):
+        """
+        Hand the task back after a failure, it is given up once it was claimed max_attempts times
+        """
+        state = FAILED if lease.attempts >= self.max_attempts else PENDING
+        with self._lock:
+            self._connection.execute("UPDATE tasks SET state = ?, worker = NULL, lease_until = 0, error = ? "
+                                     "WHERE id = ? AND worker = ?",
+                                     (state, error, int(lease.task_id), lease.worker))
+
+    def active_workers(self) -> int:
+        """
+        :return: number of workers that claimed or renewed a lease within the last lease_seconds
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM workers WHERE seen_at >= ?",
+                                            (time() - self.lease_seconds,)).fetchone()[0]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+
+    def unfinished(self) -> int:
+        counts = self.counts()
+        return counts.get(PENDING, 0) + counts.get(LEASED, 0)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class MongoLeaseQueue:
+    """
+    Work queue in a mongo collection, shared by crawlers on different machines.
+    Same semantics as LocalLeaseQueue, workers report in the collection "<name>_workers".
+    """
+    collection: Collection
+    workers: Collection
+    lease_seconds: float
+    max_attempts: int
+
+    def __init__(self, collection: Collection, lease_seconds: float = 300, max_attempts: int = 5):
+        self.collection = collection
+        self.workers = collection.database[collection.name + "_workers"]
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.collection.create_index([("state", 1), ("lease_until", 1)])
+
+    def add_playlist(self, playlist_id: str, total: int, range_size: int = 500) -> int:
+        ranges = playlist_ranges(total, range_size)
+        if len(ranges) > 0:
+            self.collection.insert_many([self._task(playlist_id=playlist_id, start=offset, end=end)
+                                         for offset, end in ranges])
+        return len(ranges)
+
+    def add_tracks(self, track_ids: List[str], batch_size: int = 50) -> int:
+        batches = list(Partition(track_ids, batch_size))
+        if len(batches) > 0:
+            self.collection.insert_many([self._task(track_ids=batch) for batch in batches])
+        return len(batches)
+
+    def claim(self, worker: str) -> Optional[Lease]:
+        now = time()
+        self.collection.update_many({"state": LEASED, "lease_until": {"$lt": now},
+                                     "attempts": {"$gte": self.max_attempts}},
+                                    {"$set": {"state": FAILED, "worker": None}})
+        task = self.collection.find_one_and_update(
+            {"$or": [{"state": PENDING}, {"state": LEASED, "lease_until": {"$lt": now}}]},
+            {"$set": {"state": LEASED, "worker": worker, "lease_until": now + self.lease_seconds},
+             "$inc": {"attempts": 1}},
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER)
+        self._heartbeat(worker, now)
+        if task is None:
+            return None
+        return Lease(str(task["_id"]), worker, task["playlist_id"], task["start"], task["end"],
+                     task["track_ids"], task["attempts"])
+
+    def renew(self, lease: Lease) -> bool:
+        now = time()
+        result = self.collection.update_one({"_id": self._id(lease), "worker": lease.worker, "state": LEASED},
+                                            {"$set": {"lease_until": now + self.lease_seconds}})
+        self._heartbeat(lease.worker, now)
+        return result.matched_count == 1
+
+    def complete(self, lease: Lease):
+        self.collection.update_one({"_id": self._id(lease), "worker": lease.worker},
+                                   {"$set": {"state": DONE, "error": None}})
+
+    def release(self, lease: Lease, error: Optional[str] = None):
+        state = FAILED if lease.attempts >= self.max_attempts else PENDING
+        self.collection.update_one({"_id": self._id(lease), "worker": lease.worker},
+                                   {"$set": {"state": state, "worker": None, "lease_until": 0, "error": error}})
+
+    def active_workers(self) -> int:
+        return self.workers.count_documents({"seen_at": {"$gte": time() - self.lease_seconds}})
+
+    def counts(self) -> Dict[str, int]:
+        return {group["_id"]: group["count"]
+                for group in self.collection.aggregate([{"$group": {"_id": "$state", "count": {"$sum": 1}}}])}
+
+    def unfinished(self) -> int:
+        return self.collection.count_documents({"state": {"$in": [PENDING, LEASED]}})
+
+    def close(self):
+        pass
+
+    def _heartbeat(self, worker: str, now: float):
+        self.workers.update_one({"_id": worker}, {"$set": {"seen_at": now}}, upsert=True)
+
+    @staticmethod
+    def _task(playlist_id: Optional[str] = None, start: int = 0, end: int = 0,
+              track_ids: Optional[List[str]] = None) -> dict:
+        return {"playlist_id": playlist_id, "start": start, "end": end,
+                "track_ids": track_ids if track_ids is not None else [],
+                "state": PENDING, "worker": None, "lease_until": 0, "attempts": 0, "error": None}
+
+    @staticmethod
+    def _id(lease: Lease):
+        return ObjectId(lease.task_id)
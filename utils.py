@@ -1,27 +1,184 @@
+import os
+from typing import Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
 from pandas import DataFrame
 import matplotlib.pyplot as plt
 
+Frames = Union[DataFrame, Iterable[DataFrame]]
+
+
+def read_chunks(path: str, chunk_size: int = 100_000, columns: Optional[List[str]] = None) -> Iterator[DataFrame]:
+    """
+    Read a csv file or a parquet directory, e.g. the output of project/export.py, chunk by chunk
+    :param columns: only read these columns
+    """
+    if os.path.isdir(path) or path.endswith(".parquet"):
+        import pyarrow.dataset as ds
+        for batch in ds.dataset(path, format="parquet").to_batches(columns=columns, batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, usecols=columns)
+
+
+def chunks(data: Frames, chunk_size: int = 100_000) -> Iterator[DataFrame]:
+    """
+    :param data: a dataframe, which is split into chunks of chunk_size rows, or an iterable of dataframes
+    """
+    if isinstance(data, DataFrame):
+        for start in range(0, len(data), chunk_size):
+            yield data.iloc[start:start + chunk_size]
+    else:
+        yield from data
+
 
-def ratio(df: DataFrame, feature: str) -> DataFrame:
+def ratio(df: Frames, feature: str) -> DataFrame:
     """
     Calculate the class distribution ratio of a feature by using the feature with the least samples as the basis
     for the calculation
-    :param df: dataframe
+    :param df: dataframe or iterable of dataframes, e.g. read_chunks of a file that does not fit into memory
     :param feature: which feature should be used for grouping
     :return: ratio for each characteristic
     """
-    g = df.groupby([feature]).size().to_frame(name="samples")
+    counts = pd.Series(dtype=np.int64)
+    for chunk in chunks(df):
+        counts = counts.add(chunk[feature].value_counts(), fill_value=0)
+    g = counts.sort_index().astype(np.int64).rename_axis(feature).to_frame(name="samples")
     min_samples = g.iloc[:, 0].min()
     g['ratio'] = round(g.iloc[:, 0] / min_samples, 1)
     return g
 
 
-def piggy_matrix(df: DataFrame):
+class CorrelationAccumulator:
+    """
+    Pearson correlation of numeric columns computed in a single pass over chunks. Like DataFrame.corr, every
+    pair of columns uses the rows where both are present. The products of a chunk are computed in dtype, float32
+    by default, and added to float64 totals. Values are shifted by the means of the first chunk to keep the
+    sums of squares small.
+    """
+    columns: Optional[List[str]]
+    dtype: type
+    rows: int
+
+    def __init__(self, columns: Optional[List[str]] = None, dtype: type = np.float32):
+        """
+        :param columns: columns to correlate, the numeric columns of the first chunk by default
+        """
+        self.columns = columns
+        self.dtype = dtype
+        self.rows = 0
+        self._shift = None
+        self._pairs = None
+        self._sums = None
+        self._squares = None
+        self._products = None
+
+    def add(self, df: DataFrame):
+        if self.columns is None:
+            self.columns = df.select_dtypes(['number']).columns.tolist()
+        values = df[self.columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        if self._shift is None:
+            self._shift = np.nan_to_num(np.nanmean(values, axis=0)) if len(values) > 0 else np.zeros(len(self.columns))
+            n = len(self.columns)
+            self._pairs, self._sums, self._squares, self._products = (np.zeros((n, n)) for _ in range(4))
+        present = ~np.isnan(values)
+        shifted = np.where(present, values - self._shift, 0).astype(self.dtype)
+        mask = present.astype(self.dtype)
+        self._pairs += mask.T @ mask
+        self._sums += shifted.T @ mask
+        self._squares += (shifted * shifted).T @ mask
+        self._products += shifted.T @ shifted
+        self.rows += len(values)
+
+    def update(self, data: Frames, chunk_size: int = 100_000) -> "CorrelationAccumulator":
+        for chunk in chunks(data, chunk_size):
+            self.add(chunk)
+        return self
+
+    def correlation(self) -> DataFrame:
+        """
+        :return: correlation matrix, nan for pairs with less than two common rows or a constant column
+        """
+        if self._pairs is None:
+            return DataFrame(columns=self.columns, index=self.columns, dtype=np.float64)
+        n = self._pairs
+        covariance = n * self._products - self._sums * self._sums.T
+        variance = (n * self._squares - self._sums ** 2) * (n * self._squares.T - self._sums.T ** 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = covariance / np.sqrt(variance)
+        corr[(n < 2) | (variance <= 0)] = np.nan
+        return DataFrame(np.clip(corr, -1, 1), index=self.columns, columns=self.columns)
+
+
+def correlation(data: Frames, columns: Optional[List[str]] = None, chunk_size: int = 100_000) -> DataFrame:
+    """
+    Correlation matrix of a dataframe or of chunks, see CorrelationAccumulator
+    """
+    return CorrelationAccumulator(columns).update(data, chunk_size).correlation()
+
+
+def top_correlations(corr: DataFrame, k: int = 20) -> DataFrame:
+    """
+    :return: the k pairs of different columns with the strongest absolute correlation
+    """
+    values = corr.to_numpy()
+    rows, cols = np.triu_indices(len(values), k=1)
+    strengths = np.nan_to_num(np.abs(values[rows, cols]), nan=-1)
+    top = np.argsort(-strengths, kind="stable")[:k]
+    return DataFrame({"a": corr.index[rows[top]],
+                      "b": corr.columns[cols[top]],
+                      "correlation": values[rows[top], cols[top]]})
+
+
+def correlation_clusters(corr: DataFrame, threshold: float = 0.7) -> List[List[str]]:
+    """
+    Group columns by average linkage clustering on 1 - |correlation|
+    :param threshold: minimum average absolute correlation within a cluster
+    :return: clusters of columns, largest first
+    """
+    from scipy.cluster.hierarchy import fcluster, linkage
+    from scipy.spatial.distance import squareform
+
+    if len(corr) < 2:
+        return [corr.columns.tolist()]
+    distance = 1 - np.abs(np.nan_to_num(corr.to_numpy()))
+    np.fill_diagonal(distance, 0)
+    labels = fcluster(linkage(squareform(distance, checks=False), method="average"), 1 - threshold,
+                      criterion="distance")
+    clusters = {}
+    for column, label in zip(corr.columns, labels):
+        clusters.setdefault(label, []).append(column)
+    return sorted(clusters.values(), key=len, reverse=True)
+
+
+def clustered(corr: DataFrame, threshold: float = 0.7, min_size: int = 1) -> DataFrame:
+    """
+    :param min_size: drop clusters with fewer columns
+    :return: correlation matrix ordered so that correlated columns form blocks along the diagonal
+    """
+    order = [column for cluster in correlation_clusters(corr, threshold) if len(cluster) >= min_size
+             for column in cluster]
+    return corr.loc[order, order]
+
+
+def piggy_matrix(df: Frames, top: Optional[int] = None, cluster: bool = False):
+    """
+    :param df: dataframe or iterable of dataframes
+    :param top: only show the columns of the top strongest correlated pairs
+    :param cluster: order the columns into blocks of correlated columns
+    """
+    corr = correlation(df)
+    if top is not None:
+        pairs = top_correlations(corr, top)
+        columns = list(dict.fromkeys(pairs["a"].tolist() + pairs["b"].tolist()))
+        corr = corr.loc[columns, columns]
+    if cluster:
+        corr = clustered(corr)
     f = plt.figure(figsize=(19, 15))
-    plt.matshow(df.corr(numeric_only=True), fignum=f.number, cmap="PRGn")
-    plt.xticks(range(df.select_dtypes(['number']).shape[1]), df.select_dtypes(['number']).columns, fontsize=14,
-               rotation=75)
-    plt.yticks(range(df.select_dtypes(['number']).shape[1]), df.select_dtypes(['number']).columns, fontsize=14)
+    plt.matshow(corr, fignum=f.number, cmap="PRGn")
+    plt.xticks(range(corr.shape[1]), corr.columns, fontsize=14, rotation=75)
+    plt.yticks(range(corr.shape[1]), corr.columns, fontsize=14)
     cb = plt.colorbar()
     cb.ax.tick_params(labelsize=14)
     plt.title('Correlation Matrix', fontsize=16)